@@ -1,18 +1,443 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, session, flash, send_from_directory, g, \
+    Response, stream_with_context, get_flashed_messages, make_response, has_request_context, abort, \
+    jsonify, has_app_context
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
+from werkzeug.utils import safe_join
+from werkzeug.serving import make_server
+import click
 import sqlite3
 import os
-from datetime import datetime
+import base64
+import bisect
+import contextlib
+import csv
+import functools
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import logging
+import math
+import mimetypes
+import multiprocessing
+import pathlib
+import queue
+import re
+import secrets
+import signal
+import smtplib
+import threading
+import time
+import zlib
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from email.message import EmailMessage
+
+try:
+    from PIL import Image
+except ImportError:
+    # Without Pillow uploads are stored and served as-is
+    Image = None
+
+try:
+    import brotli
+except ImportError:
+    # Without brotli assets are only precompressed with gzip
+    brotli = None
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
 
 app = Flask(__name__)
 app.secret_key = 'your_secret_key_here'
 app.config['UPLOAD_FOLDER'] = 'static/images'
 app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif'}
+app.config['DATABASE'] = 'store.db'
+app.config['DB_POOL_SIZE'] = 8
+app.config['DB_POOL_TIMEOUT'] = 5.0
+app.config['DB_STATEMENT_CACHE_SIZE'] = 256
+app.config['READ_REPLICA'] = None
+app.config['DB_PRAGMAS'] = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -16000,
+    'mmap_size': 128 * 1024 * 1024,
+    'busy_timeout': 5000,
+    'temp_store': 'MEMORY',
+}
+app.config['CATALOG_CACHE_TTL'] = 300
+app.config['CATALOG_INDEX'] = False
+app.config['CATALOG_INDEX_REFRESH'] = 1.0
+app.config['PRODUCT_CHANGES_RETENTION'] = 3600
+app.config['PRODUCT_CHANGES_PRUNE_INTERVAL'] = 600
+app.config['SEARCH_FTS'] = True
+app.config['PRODUCTS_PER_PAGE'] = 24
+app.config['MAX_PRODUCTS_PER_PAGE'] = 100
+app.config['ORDERS_PER_PAGE'] = 20
+app.config['TEMPLATE_STREAM_BUFFER'] = 8
+app.config['PAGE_CACHE'] = True
+app.config['PAGE_CACHE_TTL'] = 60
+app.config['PAGE_CACHE_MAX_BYTES'] = 32 * 1024 * 1024
+app.config['IMAGE_VARIANTS'] = {'thumb': 120, 'card': 480, 'detail': 1200}
+app.config['IMAGE_WORKERS'] = 2
+app.config['ASSETS_SOURCE'] = 'assets'
+app.config['ASSETS_FOLDER'] = 'static/assets'
+app.config['COMPRESSION'] = True
+app.config['COMPRESSION_MIN_SIZE'] = 1024
+app.config['COMPRESSION_LEVEL'] = 6
+app.config['COMPRESSION_FLUSH_SIZE'] = 16 * 1024
+app.config['COMPRESSION_TYPES'] = {'text/html', 'text/css', 'text/plain', 'text/csv', 'text/javascript',
+                                   'application/json', 'application/javascript'}
+app.config['CART_BACKEND'] = 'session'
+app.config['HOLD_TTL'] = 900
+app.config['HOLD_SWEEP_INTERVAL'] = 300
+app.config['SQL_METRICS'] = False
+app.config['SLOW_QUERY_MS'] = 100
+app.config['METRICS_TOKEN'] = None
+app.config['JOB_WORKERS'] = 2
+app.config['JOB_MAX_ATTEMPTS'] = 5
+app.config['JOB_BACKOFF'] = 30
+app.config['JOB_TIMEOUT'] = 300
+app.config['JOB_POLL_INTERVAL'] = 1.0
+app.config['LOW_STOCK_THRESHOLD'] = 5
+app.config['MAIL_SERVER'] = None
+app.config['MAIL_PORT'] = 25
+app.config['MAIL_SENDER'] = 'store@localhost'
+app.config['STORE_EMAIL'] = 'store@localhost'
+app.config['ROLLUP_INLINE_ORDERS'] = 10
+app.config['ROLLUP_BATCH_SIZE'] = 1000
+app.config['REPORTS_TOKEN'] = None
+app.config['RECOMMENDATIONS_PER_PRODUCT'] = 8
+app.config['RECOMMENDATIONS_SHOWN'] = 4
+app.config['RECOMMENDATIONS_BATCH_SIZE'] = 5000
+app.config['RECOMMENDATIONS_INTERVAL'] = 3600
+app.config['RECOMMENDATION_CACHE_TTL'] = 300
+app.config['RECOMMENDATION_CACHE_SIZE'] = 4096
+app.config['PASSWORD_HASH_METHOD'] = 'scrypt'
+app.config['PASSWORD_HASH_WORKERS'] = 2
+app.config['PASSWORD_HASH_QUEUE'] = 16
+app.config['PASSWORD_HASH_NICE'] = 10
+app.config['PASSWORD_HASH_TIMEOUT'] = 10
+app.config['LOGIN_THROTTLE_WINDOW'] = 300
+app.config['LOGIN_USER_ATTEMPTS'] = 5
+app.config['LOGIN_IP_ATTEMPTS'] = 50
+app.config['LOGIN_THROTTLE_KEYS'] = 100000
+# STORE_* environment variables override the defaults above, for the server
+# and the CLI commands alike (STORE_DATABASE=/srv/store.db,
+# STORE_SQL_METRICS=true; values are parsed as JSON where they can be)
+app.config.from_prefixed_env('STORE')
+
+# Database connections
+def connect_db(database=None, readonly=False):
+    database = database or app.config['DATABASE']
+    if readonly:
+        database = pathlib.Path(os.path.abspath(database)).as_uri() + '?mode=ro'
+    factory = InstrumentedConnection if app.config['SQL_METRICS'] else sqlite3.Connection
+    conn = sqlite3.connect(database,
+                           timeout=app.config['DB_PRAGMAS'].get('busy_timeout', 5000) / 1000,
+                           check_same_thread=False,
+                           factory=factory,
+                           cached_statements=app.config['DB_STATEMENT_CACHE_SIZE'],
+                           uri=readonly)
+    conn.row_factory = sqlite3.Row
+    for pragma, value in app.config['DB_PRAGMAS'].items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+    return conn
+
+class ConnectionPool:
+    def __init__(self, database, size, timeout):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        if can_create:
+            try:
+                return self.connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError('database connection pool exhausted')
+
+    def connect(self):
+        return connect_db(self.database)
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self.discard(conn)
+            return
+        self._idle.put(conn)
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._created -= 1
+
+    def close(self):
+        while True:
+            try:
+                self.discard(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+# Read replicas for browsing, see get_read_db(). ReadOnlyPool hands out
+# mode=ro connections to the primary file inside a read transaction, so a
+# request reads one WAL snapshot however many writes commit meanwhile.
+class ReadOnlyPool(ConnectionPool):
+    def connect(self):
+        return connect_db(self.database, readonly=True)
+
+    def acquire(self):
+        conn = super().acquire()
+        conn.execute("BEGIN")
+        return conn
+
+_pool_lock = threading.Lock()
+
+def get_pool():
+    # Pools are per process so forked workers never share sqlite handles
+    pool = app.extensions.get('db_pool')
+    if pool is None or pool.pid != os.getpid():
+        with _pool_lock:
+            pool = app.extensions.get('db_pool')
+            if pool is None or pool.pid != os.getpid():
+                pool = ConnectionPool(app.config['DATABASE'],
+                                      app.config['DB_POOL_SIZE'],
+                                      app.config['DB_POOL_TIMEOUT'])
+                app.extensions['db_pool'] = pool
+    return pool
+
+def get_read_pool():
+    pool = app.extensions.get('db_read_pool')
+    if pool is None or pool.pid != os.getpid():
+        with _pool_lock:
+            pool = app.extensions.get('db_read_pool')
+            if pool is None or pool.pid != os.getpid():
+                pool = ReadOnlyPool(app.config['DATABASE'],
+                                    app.config['DB_POOL_SIZE'],
+                                    app.config['DB_POOL_TIMEOUT'])
+                app.extensions['db_read_pool'] = pool
+    return pool
+
+# One pooled connection per app context, shared by routes, helpers and
+# context processors, and handed back to the pool on teardown
+def get_db():
+    if 'db' not in g:
+        g.db = get_pool().acquire()
+    return g.db
+
+# Connection for browsing queries that can live with slightly stale data.
+# READ_REPLICA picks where they go: None for the primary, 'readonly' for a
+# snapshot of the primary file. Signed-in users always read the primary so
+# their own reviews and orders show up straight away.
+def get_read_db():
+    if not app.config['READ_REPLICA'] or (has_request_context() and 'user_id' in session):
+        return get_db()
+    if 'read_db' not in g:
+        g.read_db = get_read_pool().acquire()
+    return g.read_db
+
+@app.teardown_appcontext
+def release_db(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        get_pool().release(conn)
+    conn = g.pop('read_db', None)
+    if conn is not None:
+        get_read_pool().release(conn)
+
+# SQL instrumentation, enabled with SQL_METRICS. Connections time every
+# statement; each request's statements are logged at debug level, added to
+# the per-endpoint counters served at /metrics and summed up in a
+# Server-Timing header. Statements slower than SLOW_QUERY_MS are logged with
+# their query plan. Timings cover execute(), which runs a statement up to
+# its first row, so rows fetched later aren't counted.
+class InstrumentedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_query(self.connection, sql, parameters, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_query(self.connection, sql, None, time.perf_counter() - start)
+
+    def executescript(self, sql_script):
+        start = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            record_query(self.connection, sql_script, None, time.perf_counter() - start)
+
+class InstrumentedConnection(sqlite3.Connection):
+    # sqlite3.Connection.execute() and friends don't go through cursor()
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+def record_query(conn, sql, parameters, seconds):
+    if has_request_context():
+        g.setdefault('sql_queries', []).append((sql, seconds))
+    if seconds * 1000 >= app.config['SLOW_QUERY_MS']:
+        request_metrics.count_slow_query()
+        app.logger.warning('Slow query (%.1fms): %s %r\n%s', seconds * 1000, ' '.join(sql.split()),
+                           parameters, explain_query(conn, sql, parameters))
+
+def explain_query(conn, sql, parameters):
+    if parameters is None:
+        return '  (no plan for executemany/executescript)'
+    try:
+        # Straight to sqlite3 so the EXPLAIN isn't recorded itself
+        rows = sqlite3.Connection.execute(conn, 'EXPLAIN QUERY PLAN ' + sql, parameters).fetchall()
+    except sqlite3.Error as e:
+        return f'  (no plan: {e})'
+    return '\n'.join(f'  {row[3]}' for row in rows)
+
+class RequestMetrics:
+    # Upper bounds of the request duration histogram, in seconds
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.endpoints = {}
+        self.slow_queries = 0
+
+    def observe(self, endpoint, seconds, queries):
+        with self._lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = {
+                    'requests': 0, 'seconds': 0.0, 'queries': 0, 'sql_seconds': 0.0,
+                    'buckets': [0] * len(self.BUCKETS),
+                }
+            stats['requests'] += 1
+            stats['seconds'] += seconds
+            stats['queries'] += len(queries)
+            stats['sql_seconds'] += sum(elapsed for _, elapsed in queries)
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    stats['buckets'][i] += 1
+
+    def count_slow_query(self):
+        with self._lock:
+            self.slow_queries += 1
+    
+    # Prometheus text exposition format
+    def render(self):
+        with self._lock:
+            endpoints = {name: dict(stats, buckets=list(stats['buckets']))
+                         for name, stats in sorted(self.endpoints.items())}
+            slow_queries = self.slow_queries
+        
+        lines = []
+        counters = (
+            ('store_requests_total', 'requests', 'Requests handled'),
+            ('store_sql_queries_total', 'queries', 'SQL statements executed'),
+            ('store_sql_seconds_total', 'sql_seconds', 'Time spent executing SQL'),
+        )
+        for metric, key, help_text in counters:
+            lines.append(f'# HELP {metric} {help_text}, by endpoint.')
+            lines.append(f'# TYPE {metric} counter')
+            for name, stats in endpoints.items():
+                lines.append(f'{metric}{{endpoint="{name}"}} {stats[key]}')
+        
+        metric = 'store_request_duration_seconds'
+        lines.append(f'# HELP {metric} Request duration, by endpoint.')
+        lines.append(f'# TYPE {metric} histogram')
+        for name, stats in endpoints.items():
+            for bound, count in zip(self.BUCKETS, stats['buckets']):
+                lines.append(f'{metric}_bucket{{endpoint="{name}",le="{bound}"}} {count}')
+            lines.append(f'{metric}_bucket{{endpoint="{name}",le="+Inf"}} {stats["requests"]}')
+            lines.append(f'{metric}_sum{{endpoint="{name}"}} {stats["seconds"]}')
+            lines.append(f'{metric}_count{{endpoint="{name}"}} {stats["requests"]}')
+        
+        lines.append('# HELP store_slow_queries_total Statements slower than SLOW_QUERY_MS.')
+        lines.append('# TYPE store_slow_queries_total counter')
+        lines.append(f'store_slow_queries_total {slow_queries}')
+        return '\n'.join(lines) + '\n'
+
+# Counters are per process; with several workers each reports its own
+request_metrics = RequestMetrics()
+
+@app.before_request
+def start_request_timer():
+    if app.config['SQL_METRICS']:
+        g.request_start = time.perf_counter()
+
+@app.after_request
+def add_server_timing(response):
+    if 'request_start' in g:
+        # Streamed pages report the work done before the first byte
+        queries = g.get('sql_queries', [])
+        sql_ms = sum(elapsed for _, elapsed in queries) * 1000
+        total_ms = (time.perf_counter() - g.request_start) * 1000
+        response.headers['Server-Timing'] = (f'sql;dur={sql_ms:.1f};desc="{len(queries)} queries", '
+                                             f'app;dur={total_ms:.1f}')
+    return response
+
+@app.teardown_request
+def record_request_metrics(exception):
+    start = g.pop('request_start', None)
+    if start is None:
+        return
+    seconds = time.perf_counter() - start
+    queries = g.pop('sql_queries', [])
+    endpoint = request.endpoint or 'unmatched'
+    request_metrics.observe(endpoint, seconds, queries)
+    if app.logger.isEnabledFor(logging.DEBUG):
+        app.logger.debug('%s %s: %d queries, %.1fms SQL, %.1fms total%s', request.method, request.path,
+                         len(queries), sum(elapsed for _, elapsed in queries) * 1000, seconds * 1000,
+                         ''.join(f'\n  {elapsed * 1000:7.2f}ms  {" ".join(sql.split())}'
+                                 for sql, elapsed in queries))
 
 # Database setup
 def init_db():
-    conn = sqlite3.connect('store.db')
+    conn = connect_db()
     c = conn.cursor()
     
     # Create tables
@@ -77,117 +502,2252 @@ def init_db():
         ]
         c.executemany("INSERT INTO products (name, description, price, image, stock, category) VALUES (?, ?, ?, ?, ?, ?)", sample_products)
     
+    if app.config['SEARCH_FTS']:
+        init_search_index(conn)
+    
     conn.commit()
+    migrate_db(conn)
     conn.close()
+    invalidate_catalog_cache()
 
-init_db()
+# Schema migrations. Each migration is a function registered with
+# @migration(version) and runs once, in version order, in its own
+# transaction; schema_version records what has been applied. Never edit a
+# migration that has shipped, add a new one instead.
+MIGRATIONS = []
 
-# Helper functions
-def get_db():
-    conn = sqlite3.connect('store.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+def migration(version):
+    def register(fn):
+        MIGRATIONS.append((version, fn))
+        return fn
+    return register
 
-def get_cart():
-    return session.get('cart', {})
+def get_schema_version(conn):
+    c = conn.cursor()
+    c.execute("SELECT MAX(version) FROM schema_version")
+    return c.fetchone()[0] or 0
 
-def calculate_cart_total():
-    cart = get_cart()
+def migrate_db(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS schema_version
+                    (version INTEGER PRIMARY KEY,
+                     name TEXT NOT NULL,
+                     applied_at TEXT NOT NULL)''')
+    conn.commit()
+    
+    applied = []
+    for version, fn in sorted(MIGRATIONS, key=lambda m: m[0]):
+        # BEGIN IMMEDIATE takes the write lock before the version check, so
+        # workers starting together apply each migration exactly once
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if version <= get_schema_version(conn):
+                conn.rollback()
+                continue
+            fn(conn)
+            conn.execute("INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)",
+                         (version, fn.__name__, datetime.now().isoformat()))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append(version)
+    return applied
+
+@migration(1)
+def add_secondary_indexes(conn):
+    c = conn.cursor()
+    # Listing filters and sorts; the implicit rowid keeps (key, id) keyset
+    # pages in index order
+    c.execute("CREATE INDEX IF NOT EXISTS idx_products_name ON products (name)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_products_price ON products (price)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_products_category_name ON products (category, name)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_products_category_price ON products (category, price)")
+    # Order history, newest first
+    c.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_date ON orders (user_id, order_date)")
+    # Covers order item listings and item counts without touching the table
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_order_items_order
+                 ON order_items (order_id, product_id, quantity, price)''')
+    # "Has this user bought this product" check before a review
+    c.execute("CREATE INDEX IF NOT EXISTS idx_order_items_product ON order_items (product_id, order_id)")
+    # Reviews for a product, newest first, and the one-review-per-user check
+    c.execute("CREATE INDEX IF NOT EXISTS idx_reviews_product_date ON reviews (product_id, review_date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_reviews_user_product ON reviews (user_id, product_id)")
+
+@migration(2)
+def add_rating_aggregates(conn):
+    c = conn.cursor()
+    c.execute("ALTER TABLE products ADD COLUMN review_count INTEGER NOT NULL DEFAULT 0")
+    c.execute("ALTER TABLE products ADD COLUMN rating_sum INTEGER NOT NULL DEFAULT 0")
+    c.execute("ALTER TABLE products ADD COLUMN rating_avg REAL NOT NULL DEFAULT 0")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_products_rating ON products (rating_avg)")
+    
+    # The aggregates follow every write to reviews in the writer's own
+    # transaction. SET expressions see the row's old values.
+    c.execute('''CREATE TRIGGER IF NOT EXISTS reviews_rating_insert AFTER INSERT ON reviews BEGIN
+                     UPDATE products SET review_count = review_count + 1,
+                                         rating_sum = rating_sum + new.rating,
+                                         rating_avg = (rating_sum + new.rating) * 1.0 / (review_count + 1)
+                     WHERE id = new.product_id;
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS reviews_rating_delete AFTER DELETE ON reviews BEGIN
+                     UPDATE products SET review_count = review_count - 1,
+                                         rating_sum = rating_sum - old.rating,
+                                         rating_avg = CASE WHEN review_count > 1
+                                                      THEN (rating_sum - old.rating) * 1.0 / (review_count - 1)
+                                                      ELSE 0 END
+                     WHERE id = old.product_id;
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS reviews_rating_update
+                 AFTER UPDATE OF rating, product_id ON reviews BEGIN
+                     UPDATE products SET review_count = review_count - 1,
+                                         rating_sum = rating_sum - old.rating,
+                                         rating_avg = CASE WHEN review_count > 1
+                                                      THEN (rating_sum - old.rating) * 1.0 / (review_count - 1)
+                                                      ELSE 0 END
+                     WHERE id = old.product_id;
+                     UPDATE products SET review_count = review_count + 1,
+                                         rating_sum = rating_sum + new.rating,
+                                         rating_avg = (rating_sum + new.rating) * 1.0 / (review_count + 1)
+                     WHERE id = new.product_id;
+                 END''')
+    
+    rebuild_rating_aggregates(conn)
+
+# Recomputes review_count, rating_sum and rating_avg from reviews and
+# returns how many products were out of step
+def rebuild_rating_aggregates(conn):
+    c = conn.cursor()
+    c.execute('''SELECT COUNT(*) FROM products p
+                 LEFT JOIN (SELECT product_id, COUNT(*) AS review_count, SUM(rating) AS rating_sum
+                            FROM reviews GROUP BY product_id) r ON r.product_id = p.id
+                 WHERE p.review_count != COALESCE(r.review_count, 0)
+                    OR p.rating_sum != COALESCE(r.rating_sum, 0)''')
+    stale = c.fetchone()[0]
+    
+    c.execute('''UPDATE products SET
+                     review_count = (SELECT COUNT(*) FROM reviews WHERE product_id = products.id),
+                     rating_sum = (SELECT COALESCE(SUM(rating), 0) FROM reviews WHERE product_id = products.id)''')
+    c.execute('''UPDATE products SET
+                     rating_avg = CASE WHEN review_count > 0 THEN rating_sum * 1.0 / review_count ELSE 0 END''')
+    return stale
+
+@migration(3)
+def add_cart_items(conn):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS cart_items
+                 (cart_id TEXT NOT NULL,
+                  product_id INTEGER NOT NULL,
+                  quantity INTEGER NOT NULL,
+                  updated_at TEXT NOT NULL,
+                  PRIMARY KEY (cart_id, product_id)) WITHOUT ROWID''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_cart_items_updated ON cart_items (updated_at)")
+
+# item_count and item_quantity are written by place_order(); rows from
+# before this migration stay NULL until backfill-order-counts fills them in,
+# and readers fall back to counting order_items meanwhile.
+@migration(4)
+def add_order_item_counts(conn):
+    c = conn.cursor()
+    c.execute("ALTER TABLE orders ADD COLUMN item_count INTEGER")
+    c.execute("ALTER TABLE orders ADD COLUMN item_quantity INTEGER")
+
+# Fills in item_count and item_quantity for up to batch_size orders that
+# lack them, in one transaction. Returns how many orders were updated.
+def backfill_order_counts(conn, batch_size):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        c = conn.cursor()
+        c.execute('''UPDATE orders SET
+                         item_count = (SELECT COUNT(*) FROM order_items WHERE order_id = orders.id),
+                         item_quantity = (SELECT COALESCE(SUM(quantity), 0) FROM order_items
+                                          WHERE order_id = orders.id)
+                     WHERE id IN (SELECT id FROM orders WHERE item_count IS NULL LIMIT ?)''',
+                  (batch_size,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return c.rowcount
+
+@app.cli.command('backfill-order-counts')
+@click.option('--batch-size', default=1000, help='Orders updated per transaction')
+def backfill_order_counts_command(batch_size):
+    # Small batches keep the write lock free for checkouts in between
+    init_db_once()
+    conn = connect_db()
     total = 0
-    conn = get_db()
+    while True:
+        updated = backfill_order_counts(conn, batch_size)
+        if not updated:
+            break
+        total += updated
+    conn.close()
+    print(f'Backfilled item counts for {total} orders')
+
+# SKUs identify products in the POS feeds that import-products reads.
+# Products created here before SKUs existed keep a NULL one.
+@migration(5)
+def add_product_skus(conn):
     c = conn.cursor()
+    c.execute("ALTER TABLE products ADD COLUMN sku TEXT")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_products_sku ON products (sku)")
+
+# product_changes logs which products were inserted, updated or deleted so
+# each process's CatalogIndex can catch up without reloading everything.
+# changed_at is local time like the rest of the schema.
+@migration(6)
+def add_product_changes(conn):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS product_changes
+                 (seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                  product_id INTEGER NOT NULL,
+                  changed_at TEXT NOT NULL)''')
+
+# Logs inserted, deleted and re-indexed products to product_changes while
+# CATALOG_INDEX is on and drops the triggers while it is off, so the log
+# is only written when an index reads it. Stock isn't indexed, so checkout
+# and stock syncs don't log. Run every process with the same CATALOG_INDEX.
+PRODUCT_CHANGE_TRIGGERS = ('products_log_insert', 'products_log_delete', 'products_log_update')
+
+def sync_product_change_log(conn):
+    c = conn.cursor()
+    if not app.config['CATALOG_INDEX']:
+        for trigger in PRODUCT_CHANGE_TRIGGERS:
+            c.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        conn.commit()
+        return
+    c.execute('''CREATE TRIGGER IF NOT EXISTS products_log_insert AFTER INSERT ON products BEGIN
+                     INSERT INTO product_changes (product_id, changed_at)
+                     VALUES (new.id, strftime('%Y-%m-%dT%H:%M:%S', 'now', 'localtime'));
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS products_log_delete AFTER DELETE ON products BEGIN
+                     INSERT INTO product_changes (product_id, changed_at)
+                     VALUES (old.id, strftime('%Y-%m-%dT%H:%M:%S', 'now', 'localtime'));
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS products_log_update
+                 AFTER UPDATE OF name, price, category, rating_avg ON products BEGIN
+                     INSERT INTO product_changes (product_id, changed_at)
+                     VALUES (new.id, strftime('%Y-%m-%dT%H:%M:%S', 'now', 'localtime'));
+                 END''')
+    conn.commit()
+
+# Outbox for work done after a request commits, see enqueue_job()
+@migration(7)
+def add_jobs(conn):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS jobs
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  kind TEXT NOT NULL,
+                  payload TEXT NOT NULL,
+                  idempotency_key TEXT UNIQUE,
+                  status TEXT NOT NULL DEFAULT 'pending',
+                  attempts INTEGER NOT NULL DEFAULT 0,
+                  run_at TEXT NOT NULL,
+                  created_at TEXT NOT NULL,
+                  started_at TEXT,
+                  finished_at TEXT,
+                  last_error TEXT)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_run_at ON jobs (status, run_at)")
+
+# Stock held by carts, see hold_stock()
+@migration(8)
+def add_stock_holds(conn):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS stock_holds
+                 (holder TEXT NOT NULL,
+                  product_id INTEGER NOT NULL,
+                  quantity INTEGER NOT NULL,
+                  expires_at TEXT NOT NULL,
+                  PRIMARY KEY (holder, product_id)) WITHOUT ROWID''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_stock_holds_product
+                 ON stock_holds (product_id, expires_at, holder, quantity)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_stock_holds_expires ON stock_holds (expires_at)")
+
+# Daily sales rollups, see roll_up_sales(). Orders before this migration
+# are folded in by the queued catch-up job or `flask roll-up-sales`.
+@migration(9)
+def add_sales_rollups(conn):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS sales_daily
+                 (day TEXT PRIMARY KEY,
+                  orders INTEGER NOT NULL,
+                  units INTEGER NOT NULL,
+                  revenue_cents INTEGER NOT NULL) WITHOUT ROWID''')
+    c.execute('''CREATE TABLE IF NOT EXISTS category_sales_daily
+                 (day TEXT NOT NULL,
+                  category TEXT NOT NULL,
+                  orders INTEGER NOT NULL,
+                  units INTEGER NOT NULL,
+                  revenue_cents INTEGER NOT NULL,
+                  PRIMARY KEY (day, category)) WITHOUT ROWID''')
+    c.execute('''CREATE TABLE IF NOT EXISTS product_sales_daily
+                 (day TEXT NOT NULL,
+                  product_id INTEGER NOT NULL,
+                  category TEXT NOT NULL,
+                  orders INTEGER NOT NULL,
+                  units INTEGER NOT NULL,
+                  revenue_cents INTEGER NOT NULL,
+                  PRIMARY KEY (day, product_id)) WITHOUT ROWID''')
+    c.execute('''CREATE TABLE IF NOT EXISTS rollup_state
+                 (name TEXT PRIMARY KEY,
+                  high_water INTEGER NOT NULL)''')
+    c.execute("INSERT OR IGNORE INTO rollup_state (name, high_water) VALUES ('sales', 0)")
+    enqueue_job(conn, 'roll_up_sales', {}, key='roll-up-sales-0')
+
+# Co-purchase counts and the top ones per product, see
+# build_recommendations()
+@migration(10)
+def add_recommendations(conn):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS product_pairs
+                 (product_id INTEGER NOT NULL,
+                  other_id INTEGER NOT NULL,
+                  orders INTEGER NOT NULL,
+                  PRIMARY KEY (product_id, other_id)) WITHOUT ROWID''')
+    c.execute('''CREATE TABLE IF NOT EXISTS product_recommendations
+                 (product_id INTEGER NOT NULL,
+                  rank INTEGER NOT NULL,
+                  other_id INTEGER NOT NULL,
+                  orders INTEGER NOT NULL,
+                  PRIMARY KEY (product_id, rank)) WITHOUT ROWID''')
+    c.execute("INSERT OR IGNORE INTO rollup_state (name, high_water) VALUES ('co_purchases', 0)")
+    enqueue_job(conn, 'build_recommendations', {}, key='build-recommendations-0')
+
+@app.cli.command('prune-product-changes')
+@click.option('--hours', default=24, help='Keep changes logged within this many hours')
+def prune_product_changes_command(hours):
+    init_db_once()
+    conn = connect_db()
+    deleted = prune_product_changes(conn, hours * 3600)
+    conn.close()
+    print(f'Deleted {deleted} product changes')
+
+@app.cli.command('rebuild-ratings')
+def rebuild_ratings_command():
+    init_db_once()
+    conn = connect_db()
+    stale = rebuild_rating_aggregates(conn)
+    conn.commit()
+    conn.close()
+    print(f'Rating aggregates rebuilt, {stale} products were out of date')
+
+@app.cli.command('migrate-db')
+def migrate_db_command():
+    # init_db_once() also creates the tables of a fresh database
+    start = datetime.now().isoformat()
+    init_db_once()
+    conn = connect_db()
+    c = conn.cursor()
+    c.execute("SELECT version FROM schema_version WHERE applied_at >= ? ORDER BY version", (start,))
+    for row in c.fetchall():
+        print(f'Applied migration {row[0]}')
+    print(f'Schema version {get_schema_version(conn)}')
+    conn.close()
+
+# Full-text product search. products_fts is an external-content FTS5 index
+# over products, kept in sync by triggers so writers don't have to know
+# about it.
+def init_search_index(conn):
+    c = conn.cursor()
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'products_fts'")
+    exists = c.fetchone() is not None
+    
+    try:
+        c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS products_fts
+                     USING fts5(name, description, category,
+                                content='products', content_rowid='id',
+                                tokenize='unicode61 remove_diacritics 2',
+                                prefix='2 3')''')
+    except sqlite3.OperationalError:
+        # SQLite built without FTS5; home() falls back to LIKE search
+        app.config['SEARCH_FTS'] = False
+        return
+    
+    c.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+                     INSERT INTO products_fts (rowid, name, description, category)
+                     VALUES (new.id, new.name, new.description, new.category);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+                     INSERT INTO products_fts (products_fts, rowid, name, description, category)
+                     VALUES ('delete', old.id, old.name, old.description, old.category);
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_update
+                 AFTER UPDATE OF name, description, category ON products BEGIN
+                     INSERT INTO products_fts (products_fts, rowid, name, description, category)
+                     VALUES ('delete', old.id, old.name, old.description, old.category);
+                     INSERT INTO products_fts (rowid, name, description, category)
+                     VALUES (new.id, new.name, new.description, new.category);
+                 END''')
+    
+    if not exists:
+        rebuild_search_index(conn)
+
+def rebuild_search_index(conn):
+    conn.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+    conn.execute("INSERT INTO products_fts (products_fts) VALUES ('optimize')")
+
+def search_match_expression(search):
+    # Every word must match, each as a prefix so partial input still hits
+    terms = re.findall(r'\w+', search)
+    return ' '.join('"{}"*'.format(term) for term in terms)
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    init_db_once()
+    conn = connect_db()
+    init_search_index(conn)
+    if app.config['SEARCH_FTS']:
+        rebuild_search_index(conn)
+        conn.commit()
+        print('Search index rebuilt')
+    else:
+        print('FTS5 is not available in this SQLite build')
+    conn.close()
+
+# Product feeds. import-products streams a CSV or JSONL feed into products
+# in chunks of --chunk-size rows, one transaction each, upserting on sku.
+# Feeds may carry any subset of PRODUCT_FEED_COLUMNS besides sku; a feed
+# without name and price can only update existing SKUs (a stock and price
+# sync, say). Rows whose values haven't changed aren't written. Running
+# servers pick the changes up when their catalog and page caches expire.
+PRODUCT_FEED_COLUMNS = ('sku', 'name', 'description', 'price', 'stock', 'category', 'image')
+
+def feed_format(path, fmt):
+    if fmt:
+        return fmt
+    return 'jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv'
+
+def read_product_feed(file, fmt):
+    if fmt == 'jsonl':
+        for line_number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = {'__error__': 'invalid JSON'}
+            if not isinstance(row, dict):
+                # Reported by parse_product_row() like any other bad row
+                row = {'__error__': 'not a JSON object'}
+            yield line_number, row
+    else:
+        # Line numbers count the header
+        for line_number, row in enumerate(csv.DictReader(file), 2):
+            yield line_number, row
+
+def parse_product_row(row, columns):
+    if '__error__' in row:
+        raise ValueError(row['__error__'])
+    values = {}
+    for column in columns:
+        value = row.get(column)
+        if value == '' and column not in ('sku', 'name'):
+            value = None
+        if value is None and column in ('price', 'stock'):
+            raise ValueError(f'missing {column}')
+        if column == 'price':
+            try:
+                price = Decimal(str(value))
+                if not price.is_finite() or price < 0:
+                    raise InvalidOperation
+                value = float(price.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP))
+            except InvalidOperation:
+                raise ValueError(f'invalid price {value!r}')
+        elif column == 'stock':
+            try:
+                stock = int(value)
+            except (ValueError, TypeError, OverflowError):
+                raise ValueError(f'invalid stock {value!r}')
+            if stock < 0:
+                raise ValueError(f'invalid stock {value!r}')
+            value = stock
+        elif value is not None:
+            value = str(value)
+        values[column] = value
+    if not values['sku']:
+        raise ValueError('missing sku')
+    if 'name' in values and not values['name']:
+        raise ValueError('missing name')
+    return values
+
+def product_upsert_statement(columns):
+    updates = [column for column in columns if column != 'sku']
+    changed = ' OR '.join(f'products.{column} IS NOT excluded.{column}' for column in updates)
+    if 'name' in columns and 'price' in columns:
+        return f'''INSERT INTO products ({', '.join(columns)})
+                   VALUES ({', '.join(['?'] * len(columns))})
+                   ON CONFLICT (sku) DO UPDATE SET
+                   {', '.join(f'{column} = excluded.{column}' for column in updates)}
+                   WHERE {changed}'''
+    return f'''UPDATE products SET {', '.join(f'{column} = ?' for column in updates)}
+               WHERE sku = ? AND ({' OR '.join(f'{column} IS NOT ?' for column in updates)})'''
+
+def import_products(conn, rows, columns, chunk_size, on_error):
+    statement = product_upsert_statement(columns)
+    updates = [column for column in columns if column != 'sku']
+    upsert = 'name' in columns and 'price' in columns
+    stats = {'rows': 0, 'written': 0, 'skipped': 0}
+
+    def flush(batch):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # rowcount leaves out the FTS writes made by triggers
+            stats['written'] += conn.executemany(statement, batch).rowcount
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
     
-    for product_id, quantity in cart.items():
-        c.execute("SELECT price FROM products WHERE id = ?", (product_id,))
-        product = c.fetchone()
-        if product:
-            total += product['price'] * quantity
+    batch = []
+    for line_number, row in rows:
+        stats['rows'] += 1
+        try:
+            values = parse_product_row(row, columns)
+        except ValueError as e:
+            stats['skipped'] += 1
+            on_error(line_number, e)
+            continue
+        if upsert:
+            batch.append([values[column] for column in columns])
+        else:
+            batch.append([values[column] for column in updates] + [values['sku']] +
+                         [values[column] for column in updates])
+        if len(batch) >= chunk_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+    return stats
+
+@app.cli.command('import-products')
+@click.argument('feed', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']),
+              help='Feed format; by default .jsonl and .ndjson files are JSONL, anything else CSV')
+@click.option('--chunk-size', default=1000, help='Rows written per transaction')
+def import_products_command(feed, fmt, chunk_size):
+    fmt = feed_format(feed.name, fmt)
+    rows = read_product_feed(feed, fmt)
+    
+    # The header, or the keys of the first JSON object, decide the columns
+    first = next(rows, None)
+    if first is None:
+        print('Feed is empty')
+        return
+    line_number, row = first
+    if '__error__' in row:
+        raise click.ClickException(f"Line {line_number}: {row['__error__']}")
+    columns = [column for column in PRODUCT_FEED_COLUMNS if column in row]
+    if 'sku' not in columns:
+        raise click.ClickException('The feed has no sku column')
+    if 'name' not in columns or 'price' not in columns:
+        print('The feed lacks name or price, so only existing SKUs are updated')
+
+    def on_error(line_number, error):
+        click.echo(f'Line {line_number}: skipped, {error}', err=True)
     
+    init_db_once()
+    conn = connect_db()
+    start = time.perf_counter()
+    try:
+        stats = import_products(conn, itertools.chain([first], rows), columns, chunk_size, on_error)
+    finally:
+        conn.close()
+    elapsed = time.perf_counter() - start
+    unchanged = 'unchanged' if 'name' in columns and 'price' in columns else 'unchanged or unknown'
+    print(f"{stats['rows']} rows in {elapsed:.2f}s ({stats['rows'] / max(elapsed, 1e-9):.0f} rows/s): "
+          f"{stats['written']} written, {stats['rows'] - stats['written'] - stats['skipped']} {unchanged}, "
+          f"{stats['skipped']} skipped")
+
+# Streams products out in id order, so memory use doesn't grow with the
+# catalog. The output can be fed back to import-products, which skips
+# products that have no SKU.
+@app.cli.command('export-products')
+@click.argument('output', type=click.File('w', encoding='utf-8'), default='-')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']),
+              help='Output format; by default chosen from the file name like import-products')
+def export_products_command(output, fmt):
+    fmt = feed_format(output.name, fmt)
+    init_db_once()
+    conn = connect_db()
+    start = time.perf_counter()
+    count = 0
+    try:
+        c = conn.cursor()
+        c.execute(f"SELECT id, {', '.join(PRODUCT_FEED_COLUMNS)} FROM products ORDER BY id")
+        if fmt == 'jsonl':
+            for row in c:
+                output.write(json.dumps(dict(row)) + '\n')
+                count += 1
+        else:
+            writer = csv.writer(output, lineterminator='\n')
+            writer.writerow(('id',) + PRODUCT_FEED_COLUMNS)
+            for row in c:
+                writer.writerow(tuple(row))
+                count += 1
+    finally:
+        conn.close()
+    elapsed = time.perf_counter() - start
+    click.echo(f'Exported {count} products in {elapsed:.2f}s ({count / max(elapsed, 1e-9):.0f} rows/s)',
+               err=True)
+
+# Catalog metadata cache (categories, per-category counts, price range).
+# Anything that inserts, deletes or re-prices products must call
+# invalidate_catalog_cache(); stock-only updates don't affect it.
+class CatalogCache:
+    def __init__(self):
+        self._data = None
+        self._expires = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, loader, ttl):
+        data = self._data
+        if data is not None and time.monotonic() < self._expires:
+            return data
+        
+        with self._lock:
+            generation = self._generation
+        data = loader()
+        with self._lock:
+            # Don't store a result that raced with an invalidation
+            if generation == self._generation:
+                self._data = data
+                self._expires = time.monotonic() + ttl
+        return data
+
+    def invalidate(self):
+        with self._lock:
+            self._data = None
+            self._generation += 1
+
+catalog_cache = CatalogCache()
+
+def load_catalog_meta():
+    c = get_read_db().cursor()
+    c.execute('''SELECT category, COUNT(*) AS product_count,
+                        MIN(price) AS min_price, MAX(price) AS max_price
+                 FROM products
+                 GROUP BY category
+                 ORDER BY category''')
+    rows = c.fetchall()
+    
+    prices = [row['min_price'] for row in rows] + [row['max_price'] for row in rows]
+    return {
+        'categories': [row['category'] for row in rows if row['category'] is not None],
+        'category_counts': {row['category']: row['product_count']
+                            for row in rows if row['category'] is not None},
+        'product_count': sum(row['product_count'] for row in rows),
+        'min_price': min(prices) if prices else 0,
+        'max_price': max(prices) if prices else 0,
+    }
+
+def get_catalog_meta():
+    return catalog_cache.get(load_catalog_meta, app.config['CATALOG_CACHE_TTL'])
+
+def invalidate_catalog_cache():
+    catalog_cache.invalidate()
+    invalidate_page_cache()
+
+# Rendered page cache for anonymous browsing. Pages are keyed on endpoint,
+# view args and the query args that shape them, evicted least recently used
+# once PAGE_CACHE_MAX_BYTES is reached, and expire after PAGE_CACHE_TTL so
+# writes made by other processes show up eventually.
+class PageCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() >= entry['expires']:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry, generation):
+        size = len(entry['body'])
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            # Don't store a page rendered before an invalidation
+            if generation != self._generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._size += size
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, match=None):
+        with self._lock:
+            self._generation += 1
+            for key in [key for key in self._entries if match is None or match(key)]:
+                self._remove(key)
+
+    def _remove(self, key):
+        self._size -= len(self._entries.pop(key)['body'])
+
+page_cache = PageCache(app.config['PAGE_CACHE_MAX_BYTES'])
+
+# Drops cached listings and the pages of the given products (all pages if
+# product_ids is None). Call after writing products or reviews.
+def invalidate_page_cache(product_ids=None):
+    if product_ids is None:
+        page_cache.invalidate()
+        return
+    product_ids = {int(product_id) for product_id in product_ids}
+    page_cache.invalidate(lambda key: key[0] != 'product_detail' or
+                          dict(key[1]).get('product_id') in product_ids)
+
+# Query args that change what home() renders; anything else is ignored
+PAGE_CACHE_ARGS = ('category', 'search', 'sort', 'min_price', 'max_price', 'min_rating',
+                   'page_size', 'after')
+
+def page_cacheable():
+    # Signed-in users, carts and pending flashes all change the page
+    return (app.config['PAGE_CACHE'] and request.method == 'GET' and
+            'user_id' not in session and not session.get('cart') and 'cart_id' not in session and
+            '_flashes' not in session)
+
+def page_cache_key():
+    # The views read the first value of each arg, so that is what keys a page
+    args = tuple((name, request.args[name]) for name in PAGE_CACHE_ARGS if request.args.get(name))
+    return (request.endpoint, tuple(sorted(request.view_args.items())), args)
+
+def cached_page(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not page_cacheable():
+            return view(*args, **kwargs)
+        
+        key = page_cache_key()
+        entry = page_cache.get(key)
+        if entry is None:
+            generation = page_cache.generation
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            body = response.get_data()
+            entry = {
+                'body': body,
+                'content_type': response.content_type,
+                'etag': hashlib.blake2b(body, digest_size=16).hexdigest(),
+                'last_modified': datetime.now(timezone.utc).replace(microsecond=0),
+                'expires': time.monotonic() + app.config['PAGE_CACHE_TTL'],
+            }
+            page_cache.put(key, entry, generation)
+        
+        response = Response(entry['body'], content_type=entry['content_type'])
+        if should_compress(response):
+            # Compressed once per cached page rather than once per hit
+            if 'gzip' not in entry:
+                entry['gzip'] = gzip.compress(entry['body'], app.config['COMPRESSION_LEVEL'])
+            g.compressed_body = entry['gzip']
+        response.set_etag(entry['etag'])
+        response.last_modified = entry['last_modified']
+        # Browsers revalidate every time and get a 304 while the page holds
+        response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+        return response.make_conditional(request)
+    return wrapper
+
+# Helper functions
+
+# Carts map product ids (as strings) to quantities. With CART_BACKEND set
+# to 'session' they live in the signed session cookie; with 'database' they
+# live in cart_items and the cookie only carries a random cart id, so its
+# size stays fixed however big the cart gets.
+def get_cart():
+    if app.config['CART_BACKEND'] != 'database':
+        return session.get('cart', {})
+    if 'cart' not in g:
+        g.cart = load_cart(session.get('cart_id'))
+    return g.cart
+
+def load_cart(cart_id):
+    if not cart_id:
+        return {}
+    c = get_db().cursor()
+    c.execute("SELECT product_id, quantity FROM cart_items WHERE cart_id = ?", (cart_id,))
+    return {str(row['product_id']): row['quantity'] for row in c.fetchall()}
+
+def save_cart(cart):
+    if app.config['CART_BACKEND'] != 'database':
+        session['cart'] = cart
+        return
+    if not cart:
+        clear_cart()
+        return
+    
+    cart_id = session.get('cart_id')
+    if cart_id is None:
+        cart_id = session['cart_id'] = secrets.token_urlsafe(16)
+    
+    conn = get_db()
+    updated_at = datetime.now().isoformat()
+    try:
+        conn.execute("DELETE FROM cart_items WHERE cart_id = ?", (cart_id,))
+        conn.executemany('''INSERT INTO cart_items (cart_id, product_id, quantity, updated_at)
+                            VALUES (?, ?, ?, ?)''',
+                         [(cart_id, int(product_id), quantity, updated_at)
+                          for product_id, quantity in cart.items()])
+        conn.commit()
+    except sqlite3.Error:
+        conn.rollback()
+        raise
+    g.cart = dict(cart)
+
+def clear_cart():
+    session.pop('cart', None)
+    cart_id = session.pop('cart_id', None)
+    if cart_id is not None:
+        conn = get_db()
+        conn.execute("DELETE FROM cart_items WHERE cart_id = ?", (cart_id,))
+        conn.execute("DELETE FROM stock_holds WHERE holder = ?", (cart_id,))
+        conn.commit()
+    g.cart = {}
+
+@app.cli.command('prune-carts')
+@click.option('--days', default=30, help='Delete carts untouched for this many days')
+def prune_carts_command(days):
+    init_db_once()
+    conn = connect_db()
+    cutoff = (datetime.now() - timedelta(days=days)).isoformat()
+    c = conn.cursor()
+    c.execute('''DELETE FROM cart_items WHERE cart_id IN
+                 (SELECT cart_id FROM cart_items GROUP BY cart_id HAVING MAX(updated_at) < ?)''',
+              (cutoff,))
+    conn.commit()
     conn.close()
-    return round(total, 2)
+    print(f'Deleted {c.rowcount} cart lines')
 
-def get_cart_items():
-    cart = get_cart()
+# Stock holds. A cart holds the units in it for HOLD_TTL seconds from its
+# last change, so they aren't offered to anyone else meanwhile: available
+# stock is stock less the unexpired holds of other carts. Expired holds are
+# just ignored until the sweep_holds job deletes them, and place_order()
+# turns a cart's holds into its order. Holds are keyed on the session's
+# cart id whichever CART_BACKEND is in use.
+def cart_holder(create=False):
+    holder = session.get('cart_id')
+    if holder is None and create:
+        holder = session['cart_id'] = secrets.token_urlsafe(16)
+    return holder
+
+# The available column for a query over products p: stock less the
+# unexpired holds of carts other than holder. Returns the SQL and its params.
+def available_column(holder):
+    return ('''p.stock - COALESCE(
+                   (SELECT SUM(h.quantity) FROM stock_holds h
+                    WHERE h.product_id = p.id AND h.expires_at > ? AND h.holder IS NOT ?), 0)
+                   AS available''', [datetime.now().isoformat(), holder])
+
+def available_stock(conn, product_ids, holder=None):
+    c = conn.cursor()
+    column, params = available_column(holder)
+    query = '''SELECT p.id, p.name, {}
+               FROM products p WHERE p.id IN ({})'''.format(column, ','.join(['?'] * len(product_ids)))
+    c.execute(query, [*params, *product_ids])
+    return {str(row['id']): row for row in c.fetchall()}
+
+# Sets the holder's holds to quantities ({product_id: quantity}, where 0
+# releases the hold) and renews the rest of its holds. If any product is
+# short nothing changes, and the short ones come back as (name, available).
+# Holds that have expired may have gone to other carts meanwhile, so they
+# are only taken again where the stock is still free.
+def hold_stock(conn, holder, quantities):
+    now = datetime.now()
+    expires_at = (now + timedelta(seconds=app.config['HOLD_TTL'])).isoformat()
+    wanted = {product_id: quantity for product_id, quantity in quantities.items() if quantity > 0}
+    
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        c = conn.cursor()
+        c.execute("SELECT product_id, quantity FROM stock_holds WHERE holder = ? AND expires_at <= ?",
+                  (holder, now.isoformat()))
+        expired = {str(row['product_id']): row['quantity'] for row in c.fetchall()
+                   if str(row['product_id']) not in quantities}
+        available = available_stock(conn, list(wanted) + list(expired), holder) if wanted or expired else {}
+        short = [(available[product_id]['name'], max(available[product_id]['available'], 0))
+                 if product_id in available else (product_id, 0)
+                 for product_id, quantity in wanted.items()
+                 if product_id not in available or quantity > available[product_id]['available']]
+        if not short:
+            renewed = {product_id: quantity for product_id, quantity in expired.items()
+                       if product_id in available and quantity <= available[product_id]['available']}
+            conn.execute("DELETE FROM stock_holds WHERE holder = ? AND expires_at <= ?",
+                         (holder, now.isoformat()))
+            conn.executemany("DELETE FROM stock_holds WHERE holder = ? AND product_id = ?",
+                             [(holder, int(product_id)) for product_id, quantity in quantities.items()
+                              if quantity <= 0])
+            conn.execute("UPDATE stock_holds SET expires_at = ? WHERE holder = ?", (expires_at, holder))
+            conn.executemany('''INSERT OR REPLACE INTO stock_holds (holder, product_id, quantity, expires_at)
+                                VALUES (?, ?, ?, ?)''',
+                             [(holder, int(product_id), quantity, expires_at)
+                              for product_id, quantity in {**renewed, **wanted}.items()])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return short
+
+# Cart pricing. price_cart() prices a cart with a single query: its line
+# items with subtotals, the total and whether every line is in stock.
+# Amounts are added up in integer cents so totals are exact; the price and
+# subtotal fields are the same amounts as floats for display and storage.
+# Stock is what's available to the holder, i.e. less other carts' holds.
+def to_cents(price):
+    return int((Decimal(str(price)) * 100).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+def price_cart(conn, cart, holder=None):
     items = []
+    missing = []
+    total_cents = 0
     if cart:
-        conn = get_db()
         c = conn.cursor()
-        product_ids = list(cart.keys())
-        query = "SELECT * FROM products WHERE id IN ({})".format(','.join(['?']*len(product_ids)))
-        c.execute(query, product_ids)
-        products = c.fetchall()
-        for product in products:
+        column, params = available_column(holder)
+        query = '''SELECT p.id, p.name, p.price, p.image, p.stock, {}
+                   FROM products p WHERE p.id IN ({})'''.format(column, ','.join(['?'] * len(cart)))
+        c.execute(query, [*params, *cart.keys()])
+        products = {str(row['id']): row for row in c.fetchall()}
+        
+        for product_id, quantity in cart.items():
+            product = products.get(product_id)
+            if product is None:
+                missing.append(product_id)
+                continue
+            price_cents = to_cents(product['price'])
+            subtotal_cents = price_cents * quantity
+            total_cents += subtotal_cents
             items.append({
                 'id': product['id'],
                 'name': product['name'],
-                'price': product['price'],
                 'image': product['image'],
-                'quantity': cart[str(product['id'])],
-                'subtotal': product['price'] * cart[str(product['id'])]
+                'stock': product['stock'],
+                'available': product['available'],
+                'quantity': quantity,
+                'in_stock': quantity <= product['available'],
+                'price_cents': price_cents,
+                'price': price_cents / 100,
+                'subtotal_cents': subtotal_cents,
+                'subtotal': subtotal_cents / 100,
             })
-        conn.close()
-    return items
+    
+    return {
+        'items': items,
+        'missing': missing,
+        'in_stock': not missing and all(item['in_stock'] for item in items),
+        'total_cents': total_cents,
+        'total': total_cents / 100,
+    }
+
+# The current cart's pricing, computed once per request and recomputed only
+# if the cart changes
+def get_cart_pricing():
+    cart = get_cart()
+    key = tuple(sorted(cart.items()))
+    cached = g.get('cart_pricing')
+    if cached is None or cached[0] != key:
+        cached = g.cart_pricing = (key, price_cart(get_db(), cart, cart_holder()))
+    return cached[1]
 
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
-# Routes
-@app.route('/')
-def home():
-    conn = get_db()
+# Product images. Uploads are stored under a hash of their content and
+# resized in the background into one file per IMAGE_VARIANTS size, each
+# also as WebP: abc123.jpg gets abc123-card.jpg, abc123-card.webp and so
+# on. serve_image() picks the best variant that exists.
+HASHED_IMAGE = re.compile(r'^[0-9a-f]{16}$')
+IMAGE_FORMATS = {'jpg': 'JPEG', 'jpeg': 'JPEG', 'png': 'PNG', 'gif': 'GIF', 'webp': 'WEBP'}
+
+_image_executor_lock = threading.Lock()
+
+def get_image_executor():
+    # Like the connection pool, one executor per process
+    pid, executor = app.extensions.get('image_executor', (None, None))
+    if pid != os.getpid():
+        with _image_executor_lock:
+            pid, executor = app.extensions.get('image_executor', (None, None))
+            if pid != os.getpid():
+                executor = ThreadPoolExecutor(app.config['IMAGE_WORKERS'],
+                                              thread_name_prefix='image')
+                app.extensions['image_executor'] = (os.getpid(), executor)
+    return executor
+
+def image_variant_name(filename, variant, ext=None):
+    stem, original_ext = filename.rsplit('.', 1)
+    return f'{stem}-{variant}.{ext or original_ext}'
+
+def write_file_atomic(path, write):
+    tmp_path = f'{path}.{threading.get_ident()}.tmp'
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+# Saves an upload under its content hash and queues its variants.
+# Returns the stored filename.
+def store_upload(file):
+    data = file.read()
+    ext = file.filename.rsplit('.', 1)[1].lower()
+    filename = f'{hashlib.sha256(data).hexdigest()[:16]}.{ext}'
+    path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    if not os.path.exists(path):
+        def write(tmp_path):
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+        write_file_atomic(path, write)
+    get_image_executor().submit(build_image_variants, path)
+    return filename
+
+def build_image_variants(path):
+    if Image is None:
+        return []
+    folder, filename = os.path.split(path)
+    created = []
+    try:
+        with Image.open(path) as image:
+            if getattr(image, 'is_animated', False):
+                # Resizing would keep only the first frame
+                return []
+            image.load()
+            for variant, size in app.config['IMAGE_VARIANTS'].items():
+                resized = image.copy()
+                resized.thumbnail((size, size))
+                for ext in (filename.rsplit('.', 1)[1].lower(), 'webp'):
+                    target = os.path.join(folder, image_variant_name(filename, variant, ext))
+                    if os.path.exists(target):
+                        continue
+                    fmt = IMAGE_FORMATS[ext]
+                    output = resized
+                    if fmt == 'JPEG' and output.mode not in ('RGB', 'L'):
+                        output = output.convert('RGB')
+                    write_file_atomic(target, lambda tmp_path: output.save(tmp_path, fmt, quality=85))
+                    created.append(target)
+    except Exception:
+        app.logger.exception('Could not build image variants for %s', filename)
+    return created
+
+@app.cli.command('build-image-variants')
+def build_image_variants_command():
+    if Image is None:
+        print('Pillow is not installed')
+        return
+    variant_suffixes = tuple(f'-{variant}' for variant in app.config['IMAGE_VARIANTS'])
+    folder = app.config['UPLOAD_FOLDER']
+    for filename in sorted(os.listdir(folder)):
+        if not allowed_file(filename) or filename.rsplit('.', 1)[0].endswith(variant_suffixes):
+            continue
+        created = build_image_variants(os.path.join(folder, filename))
+        print(f'{filename}: {len(created)} variants')
+
+# Static assets. `flask build-assets` copies each file in ASSETS_SOURCE to
+# ASSETS_FOLDER under a name carrying its content hash, alongside gzip and
+# (with the brotli package) brotli copies, and records the built names in
+# manifest.json. asset_url() links the built file, which never changes so
+# it's cached for a year; until assets are built it links the source file,
+# which is revalidated every time.
+ASSET_ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+def build_assets(source, folder):
+    os.makedirs(folder, exist_ok=True)
+    manifest = {}
+    for name in sorted(os.listdir(source)):
+        path = os.path.join(source, name)
+        if not os.path.isfile(path):
+            continue
+        with open(path, 'rb') as f:
+            data = f.read()
+        stem, ext = os.path.splitext(name)
+        built = f'{stem}.{hashlib.sha256(data).hexdigest()[:16]}{ext}'
+        variants = {'': data, '.gz': gzip.compress(data, 9, mtime=0)}
+        if brotli is not None:
+            variants['.br'] = brotli.compress(data, quality=11)
+        for suffix, content in variants.items():
+            target = os.path.join(folder, built + suffix)
+            if not os.path.exists(target):
+                write_file_atomic(target, lambda tmp_path: pathlib.Path(tmp_path).write_bytes(content))
+        manifest[name] = built
+    write_file_atomic(os.path.join(folder, 'manifest.json'),
+                      lambda tmp_path: pathlib.Path(tmp_path).write_text(json.dumps(manifest, indent=2)))
+    return manifest
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    manifest = build_assets(app.config['ASSETS_SOURCE'], app.config['ASSETS_FOLDER'])
+    app.extensions['asset_manifest'] = manifest
+    for name, built in manifest.items():
+        print(f'{name} -> {built}')
+    if brotli is None:
+        print('brotli is not installed, built gzip copies only')
+
+def get_asset_manifest():
+    manifest = app.extensions.get('asset_manifest')
+    if manifest is None:
+        try:
+            with open(os.path.join(app.config['ASSETS_FOLDER'], 'manifest.json')) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            manifest = {}
+        app.extensions['asset_manifest'] = manifest
+    return manifest
+
+@app.template_global()
+def asset_url(name):
+    return url_for('serve_asset', filename=get_asset_manifest().get(name, name))
+
+# Password hashing. Hashes are slow on purpose, so they run in a pool of
+# PASSWORD_HASH_WORKERS processes (per server process, like the other
+# executors) instead of on request threads, which stay free for browsing
+# during a burst of logins. Once PASSWORD_HASH_QUEUE hashes are queued or
+# running, or one takes longer than PASSWORD_HASH_TIMEOUT, run_hash()
+# raises HashQueueFull and the request gets a 429 rather than waiting. A
+# hash that timed out is cancelled if it hasn't started, and its slot is
+# only freed when it is done, so the queue never holds more than that.
+# Workers run PASSWORD_HASH_NICE steps below normal priority where the OS
+# allows it, so the CPU goes to requests first. With no workers, hashes run
+# on the request thread. Either way the request's pooled connections are
+# handed back first, so requests waiting on a hash don't hold connections
+# that browsing needs; get_db() after a hash checks out a fresh one.
+class HashQueueFull(Exception):
+    pass
+
+_hash_executor_lock = threading.Lock()
+
+def get_hash_executor():
+    pid, executor, slots = app.extensions.get('hash_executor', (None, None, None))
+    if pid != os.getpid():
+        with _hash_executor_lock:
+            pid, executor, slots = app.extensions.get('hash_executor', (None, None, None))
+            if pid != os.getpid():
+                executor = None
+                if app.config['PASSWORD_HASH_WORKERS']:
+                    # Spawned, so workers don't inherit locks held by request threads
+                    executor = ProcessPoolExecutor(app.config['PASSWORD_HASH_WORKERS'],
+                                                   mp_context=multiprocessing.get_context('spawn'),
+                                                   initializer=lower_priority,
+                                                   initargs=(app.config['PASSWORD_HASH_NICE'],))
+                slots = threading.BoundedSemaphore(app.config['PASSWORD_HASH_QUEUE'])
+                app.extensions['hash_executor'] = (os.getpid(), executor, slots)
+    return executor, slots
+
+def lower_priority(increment):
+    if increment and hasattr(os, 'nice'):
+        os.nice(increment)
+
+def run_hash(fn, *args):
+    if has_app_context():
+        release_db(None)
+    executor, slots = get_hash_executor()
+    if not slots.acquire(blocking=False):
+        raise HashQueueFull()
+    if executor is None:
+        try:
+            return fn(*args)
+        finally:
+            slots.release()
+    try:
+        future = executor.submit(fn, *args)
+    except BaseException:
+        slots.release()
+        raise
+    future.add_done_callback(lambda _: slots.release())
+    try:
+        return future.result(timeout=app.config['PASSWORD_HASH_TIMEOUT'])
+    except FutureTimeoutError:
+        future.cancel()
+        raise HashQueueFull()
+
+# The method and parameters part of hashes made with method now, e.g.
+# 'scrypt:32768:8:1' for 'scrypt'
+@functools.lru_cache(maxsize=None)
+def password_hash_prefix(method):
+    return generate_password_hash('', method).split('$', 1)[0]
+
+def hash_password(password, method):
+    return generate_password_hash(password, method)
+
+# Checks password against a stored hash. Returns whether it matches and,
+# if it does but the hash was made with other parameters than method, a
+# new hash to store in its place.
+def verify_password(stored, password, method):
+    if not check_password_hash(stored, password):
+        return False, None
+    if stored.split('$', 1)[0] != password_hash_prefix(method):
+        return True, generate_password_hash(password, method)
+    return True, None
+
+# Failed logins per key (a username or a client address), kept per
+# process. A key with `limit` failures in the last `window` seconds is
+# turned away before any hashing until the oldest of them ages out.
+class LoginThrottle:
+    def __init__(self):
+        self._failures = OrderedDict()
+        self._lock = threading.Lock()
+    
+    # Seconds until key may try again, 0 if it may now
+    def retry_after(self, key, limit, window):
+        with self._lock:
+            failures = self._failures.get(key)
+            if failures is None or len(failures) < limit:
+                return 0
+            return max(failures[-limit] + window - time.monotonic(), 0)
+
+    def record(self, key, limit, max_keys):
+        with self._lock:
+            failures = self._failures.pop(key, None) or deque(maxlen=limit)
+            failures.append(time.monotonic())
+            self._failures[key] = failures
+            while len(self._failures) > max_keys:
+                self._failures.popitem(last=False)
+
+    def reset(self, key):
+        with self._lock:
+            self._failures.pop(key, None)
+
+login_throttle = LoginThrottle()
+
+def too_many_attempts(template, retry_after):
+    flash('Too many attempts, please try again shortly', 'error')
+    response = make_response(render_template(template, cart_size=len(get_cart())), 429)
+    response.headers['Retry-After'] = str(int(retry_after) + 1)
+    return response
+
+# Background jobs. Requests enqueue work into the jobs table, in their own
+# transaction where they have one, so the job exists exactly when the
+# change that caused it does; workers started with `flask run-jobs` run
+# it afterwards. A job that raises is retried JOB_MAX_ATTEMPTS times with
+# exponential backoff from JOB_BACKOFF seconds, and one left running for
+# JOB_TIMEOUT seconds (its worker died) is picked up again, which counts
+# as an attempt too. Delivery is at least once, so handlers must cope with
+# running twice. Enqueueing with an idempotency key that was used before
+# does nothing.
+JOB_HANDLERS = {}
+
+def job_handler(kind):
+    def register(fn):
+        JOB_HANDLERS[kind] = fn
+        return fn
+    return register
+
+# Periodic jobs queue their next run before each run, for the start of the
+# next interval (the config setting named by interval_setting). The key is
+# the time slot, so a slot runs once however many workers queue it;
+# `flask run-jobs` queues the first.
+PERIODIC_JOBS = {}
+
+def periodic_job(kind, interval_setting):
+    def register(fn):
+        @job_handler(kind)
+        @functools.wraps(fn)
+        def run(payload):
+            conn = get_db()
+            schedule_periodic_job(conn, kind)
+            conn.commit()
+            fn(payload)
+        PERIODIC_JOBS[kind] = interval_setting
+        return run
+    return register
+
+def schedule_periodic_job(conn, kind):
+    interval = app.config[PERIODIC_JOBS[kind]]
+    slot = int(time.time() // interval) + 1
+    enqueue_job(conn, kind, {}, key=f'{kind}-{slot}', delay=slot * interval - time.time())
+
+def enqueue_job(conn, kind, payload, key=None, delay=0):
+    now = datetime.now()
+    conn.execute('''INSERT OR IGNORE INTO jobs (kind, payload, idempotency_key, run_at, created_at)
+                    VALUES (?, ?, ?, ?, ?)''',
+                 (kind, json.dumps(payload), key, (now + timedelta(seconds=delay)).isoformat(),
+                  now.isoformat()))
+
+# Marks the next due job as running and returns it, or None
+def claim_job(conn):
+    now = datetime.now()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        c = conn.cursor()
+        c.execute('''SELECT * FROM jobs WHERE status = 'pending' AND run_at <= ?
+                     ORDER BY run_at LIMIT 1''', (now.isoformat(),))
+        job = c.fetchone()
+        if job is None:
+            stalled = now - timedelta(seconds=app.config['JOB_TIMEOUT'])
+            # A job whose worker died on every attempt isn't tried again
+            c.execute('''UPDATE jobs SET status = 'failed', last_error = 'Stalled: worker stopped'
+                         WHERE status = 'running' AND started_at < ? AND attempts >= ?''',
+                      (stalled.isoformat(), app.config['JOB_MAX_ATTEMPTS']))
+            c.execute('''SELECT * FROM jobs WHERE status = 'running' AND started_at < ?
+                         ORDER BY started_at LIMIT 1''', (stalled.isoformat(),))
+            job = c.fetchone()
+        if job is not None:
+            c.execute('''UPDATE jobs SET status = 'running', started_at = ?, attempts = attempts + 1
+                         WHERE id = ?''', (now.isoformat(), job['id']))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return job
+
+# Runs the next due job, if any, and says whether there was one
+def run_next_job(conn):
+    job = claim_job(conn)
+    if job is None:
+        return False
+    
+    try:
+        handler = JOB_HANDLERS.get(job['kind'])
+        if handler is None:
+            raise LookupError(f"no handler for {job['kind']} jobs")
+        with app.app_context():
+            handler(json.loads(job['payload']))
+    except Exception as e:
+        app.logger.exception('Job %s (%s) failed', job['id'], job['kind'])
+        attempts = job['attempts'] + 1
+        if attempts >= app.config['JOB_MAX_ATTEMPTS']:
+            status, run_at = 'failed', job['run_at']
+        else:
+            delay = app.config['JOB_BACKOFF'] * 2 ** (attempts - 1)
+            status, run_at = 'pending', (datetime.now() + timedelta(seconds=delay)).isoformat()
+        conn.execute("UPDATE jobs SET status = ?, run_at = ?, last_error = ? WHERE id = ?",
+                     (status, run_at, f'{type(e).__name__}: {e}', job['id']))
+    else:
+        conn.execute("UPDATE jobs SET status = 'done', finished_at = ?, last_error = NULL WHERE id = ?",
+                     (datetime.now().isoformat(), job['id']))
+    conn.commit()
+    return True
+
+class JobWorkers:
+    def __init__(self, count, poll_interval):
+        self.count = count
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.count):
+            thread = threading.Thread(target=self._run, name=f'job-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+    
+    # Stops once the running jobs finish
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self):
+        conn = connect_db()
+        try:
+            while not self._stop.is_set():
+                try:
+                    ran = run_next_job(conn)
+                except sqlite3.Error:
+                    app.logger.exception('Job worker database error')
+                    ran = False
+                if not ran:
+                    self._stop.wait(self.poll_interval)
+        finally:
+            conn.close()
+
+# Queue depth by status, the age of the oldest due job, and latency from
+# enqueue to completion per kind over the last hour
+def job_stats(conn):
+    now = datetime.now()
     c = conn.cursor()
+    c.execute("SELECT status, COUNT(*) AS jobs FROM jobs GROUP BY status")
+    depth = {row['status']: row['jobs'] for row in c.fetchall()}
+    c.execute("SELECT MIN(run_at) FROM jobs WHERE status = 'pending' AND run_at <= ?", (now.isoformat(),))
+    oldest = c.fetchone()[0]
+    c.execute('''SELECT kind, COUNT(*) AS jobs,
+                        AVG((julianday(finished_at) - julianday(created_at)) * 86400) AS avg_latency,
+                        MAX((julianday(finished_at) - julianday(created_at)) * 86400) AS max_latency
+                 FROM jobs WHERE status = 'done' AND finished_at >= ?
+                 GROUP BY kind ORDER BY kind''', ((now - timedelta(hours=1)).isoformat(),))
+    return {
+        'depth': depth,
+        'oldest_due_seconds': (now - datetime.fromisoformat(oldest)).total_seconds() if oldest else 0,
+        'latency': {row['kind']: dict(row) for row in c.fetchall()},
+    }
+
+@app.cli.command('run-jobs')
+@click.option('--workers', default=None, type=int, help='Worker threads (default JOB_WORKERS)')
+@click.option('--once', is_flag=True, help='Exit once no job is due')
+def run_jobs_command(workers, once):
+    init_db_once()
+    conn = connect_db()
+    for kind in PERIODIC_JOBS:
+        schedule_periodic_job(conn, kind)
+    conn.commit()
+    if once:
+        count = 0
+        while run_next_job(conn):
+            count += 1
+        conn.close()
+        print(f'Ran {count} jobs')
+        return
+    conn.close()
     
-    category = request.args.get('category')
-    search = request.args.get('search')
-    sort = request.args.get('sort', 'name')
-    min_price = request.args.get('min_price')
-    max_price = request.args.get('max_price')
+    pool = JobWorkers(workers or app.config['JOB_WORKERS'], app.config['JOB_POLL_INTERVAL'])
+    pool.start()
+    print(f'Running jobs with {pool.count} workers')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pool.stop()
+
+@app.cli.command('job-stats')
+def job_stats_command():
+    init_db_once()
+    conn = connect_db()
+    stats = job_stats(conn)
+    conn.close()
+    print('Queue: ' + (', '.join(f'{count} {status}' for status, count in sorted(stats['depth'].items()))
+                       or 'empty'))
+    print(f"Oldest due job waiting {stats['oldest_due_seconds']:.1f}s")
+    for kind, row in stats['latency'].items():
+        print(f"  {kind:<20} {row['jobs']:6d} done in the last hour, "
+              f"latency avg {row['avg_latency']:.1f}s max {row['max_latency']:.1f}s")
+
+@app.cli.command('prune-jobs')
+@click.option('--days', default=7, help='Delete finished jobs older than this many days')
+def prune_jobs_command(days):
+    init_db_once()
+    conn = connect_db()
+    cutoff = (datetime.now() - timedelta(days=days)).isoformat()
+    c = conn.cursor()
+    c.execute("DELETE FROM jobs WHERE status = 'done' AND finished_at < ?", (cutoff,))
+    conn.commit()
+    conn.close()
+    print(f'Deleted {c.rowcount} jobs')
+
+# Sends through MAIL_SERVER, or just logs the message when none is set
+def send_mail(to, subject, body):
+    if not app.config['MAIL_SERVER']:
+        app.logger.info('Mail to %s: %s\n%s', to, subject, body)
+        return
+    message = EmailMessage()
+    message['From'] = app.config['MAIL_SENDER']
+    message['To'] = to
+    message['Subject'] = subject
+    message.set_content(body)
+    with smtplib.SMTP(app.config['MAIL_SERVER'], app.config['MAIL_PORT'], timeout=30) as smtp:
+        smtp.send_message(message)
+
+@job_handler('order_placed')
+def send_order_confirmation(payload):
+    c = get_db().cursor()
+    c.execute('''SELECT o.id, o.total, u.email, u.username FROM orders o
+                 JOIN users u ON u.id = o.user_id WHERE o.id = ?''', (payload['order_id'],))
+    order = c.fetchone()
+    if order is None or not order['email']:
+        return
+    send_mail(order['email'], f"Your order #{order['id']}",
+              f"Hi {order['username']},\n\nThanks for your order #{order['id']} "
+              f"of ${order['total']:.2f}. We'll let you know when it ships.")
+
+@job_handler('low_stock')
+def send_low_stock_alert(payload):
+    c = get_db().cursor()
+    c.execute("SELECT name, stock FROM products WHERE id = ?", (payload['product_id'],))
+    product = c.fetchone()
+    if product is None or product['stock'] > app.config['LOW_STOCK_THRESHOLD']:
+        return
+    send_mail(app.config['STORE_EMAIL'], f"Low stock: {product['name']}",
+              f"{product['name']} is down to {product['stock']} in stock.")
+
+@job_handler('contact_message')
+def forward_contact_message(payload):
+    send_mail(app.config['STORE_EMAIL'], f"Contact form: {payload['name']} <{payload['email']}>",
+              payload['message'])
+
+@periodic_job('sweep_holds', 'HOLD_SWEEP_INTERVAL')
+def sweep_stock_holds(payload):
+    conn = get_db()
+    conn.execute("DELETE FROM stock_holds WHERE expires_at <= ?", (datetime.now().isoformat(),))
+    conn.commit()
+
+# Sales reporting. Revenue by day, category and product is read from daily
+# rollups rather than by grouping all of orders and order_items, so a
+# report costs the same however many orders there are and doesn't hold up
+# checkout. Orders are folded in by id after the 'sales' high-water mark:
+# place_order() folds its own in the order transaction, and when the
+# rollups are further behind than ROLLUP_INLINE_ORDERS it leaves the rest
+# to the roll_up_sales job. The mark moves in the same transaction as the
+# rollups, so no order is counted twice. A product's category is the one
+# it had when its sales were rolled up. Top sellers still add up a row per
+# product and day, so they cost at most products x days in the range.
+def roll_up_sales(conn, batch_size):
+    c = conn.cursor()
+    c.execute("SELECT high_water FROM rollup_state WHERE name = 'sales'")
+    high_water = c.fetchone()[0]
+    c.execute("SELECT MAX(id) FROM (SELECT id FROM orders WHERE id > ? ORDER BY id LIMIT ?)",
+              (high_water, batch_size))
+    through = c.fetchone()[0]
+    if through is None:
+        return high_water
+    
+    c.execute('''INSERT INTO sales_daily (day, orders, units, revenue_cents)
+                 SELECT substr(o.order_date, 1, 10), COUNT(DISTINCT o.id), SUM(oi.quantity),
+                        SUM(CAST(ROUND(oi.price * 100) AS INTEGER) * oi.quantity)
+                 FROM orders o JOIN order_items oi ON oi.order_id = o.id
+                 WHERE o.id > ? AND o.id <= ?
+                 GROUP BY 1
+                 ON CONFLICT (day) DO UPDATE SET
+                     orders = orders + excluded.orders,
+                     units = units + excluded.units,
+                     revenue_cents = revenue_cents + excluded.revenue_cents''', (high_water, through))
+    c.execute('''INSERT INTO category_sales_daily (day, category, orders, units, revenue_cents)
+                 SELECT substr(o.order_date, 1, 10), COALESCE(p.category, ''), COUNT(DISTINCT o.id),
+                        SUM(oi.quantity), SUM(CAST(ROUND(oi.price * 100) AS INTEGER) * oi.quantity)
+                 FROM orders o JOIN order_items oi ON oi.order_id = o.id
+                 LEFT JOIN products p ON p.id = oi.product_id
+                 WHERE o.id > ? AND o.id <= ?
+                 GROUP BY 1, 2
+                 ON CONFLICT (day, category) DO UPDATE SET
+                     orders = orders + excluded.orders,
+                     units = units + excluded.units,
+                     revenue_cents = revenue_cents + excluded.revenue_cents''', (high_water, through))
+    c.execute('''INSERT INTO product_sales_daily (day, product_id, category, orders, units, revenue_cents)
+                 SELECT substr(o.order_date, 1, 10), oi.product_id, COALESCE(p.category, ''),
+                        COUNT(DISTINCT o.id), SUM(oi.quantity),
+                        SUM(CAST(ROUND(oi.price * 100) AS INTEGER) * oi.quantity)
+                 FROM orders o JOIN order_items oi ON oi.order_id = o.id
+                 LEFT JOIN products p ON p.id = oi.product_id
+                 WHERE o.id > ? AND o.id <= ?
+                 GROUP BY 1, 2
+                 ON CONFLICT (day, product_id) DO UPDATE SET
+                     orders = orders + excluded.orders,
+                     units = units + excluded.units,
+                     revenue_cents = revenue_cents + excluded.revenue_cents''', (high_water, through))
+    c.execute("UPDATE rollup_state SET high_water = ? WHERE name = 'sales'", (through,))
+    return through
+
+# Rolls up every order placed so far, a batch per write transaction
+def catch_up_sales(conn):
+    batch_size = app.config['ROLLUP_BATCH_SIZE']
+    high_water = None
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            previous, high_water = high_water, roll_up_sales(conn, batch_size)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        if high_water == previous:
+            return high_water
+
+@job_handler('roll_up_sales')
+def roll_up_sales_job(payload):
+    catch_up_sales(get_db())
+
+@app.cli.command('roll-up-sales')
+def roll_up_sales_command():
+    init_db_once()
+    conn = connect_db()
+    high_water = catch_up_sales(conn)
+    conn.close()
+    print(f'Sales rolled up through order {high_water}')
+
+SALES_REPORTS = {
+    'day': '''SELECT day, orders, units, revenue_cents FROM sales_daily
+              WHERE day BETWEEN ? AND ? ORDER BY day LIMIT ?''',
+    'category': '''SELECT category, SUM(orders) AS orders, SUM(units) AS units,
+                          SUM(revenue_cents) AS revenue_cents
+                   FROM category_sales_daily WHERE day BETWEEN ? AND ?
+                   GROUP BY category ORDER BY revenue_cents DESC, category LIMIT ?''',
+    'product': '''SELECT s.product_id, p.name, s.category, SUM(s.orders) AS orders,
+                         SUM(s.units) AS units, SUM(s.revenue_cents) AS revenue_cents
+                  FROM product_sales_daily s LEFT JOIN products p ON p.id = s.product_id
+                  WHERE s.day BETWEEN ? AND ?
+                  GROUP BY s.product_id ORDER BY revenue_cents DESC, s.product_id LIMIT ?''',
+}
+
+# Report rows for days start..end (YYYY-MM-DD, inclusive), highest revenue
+# first except by day; by='product' gives the top sellers
+def sales_report(conn, by, start, end, limit=-1):
+    c = conn.cursor()
+    c.execute(SALES_REPORTS[by], (start, end, limit))
+    return [dict(row, revenue=row['revenue_cents'] / 100) for row in c.fetchall()]
+
+# Co-purchase recommendations. product_pairs counts, for each ordered pair
+# of products, the orders that contain both; it is built by the
+# build_recommendations job (hourly) or `flask build-recommendations` from
+# the orders after the 'co_purchases' high-water mark, counting a batch of
+# orders with one self-join of order_items. product_recommendations holds
+# the top RECOMMENDATIONS_PER_PRODUCT pairs of each product and is all that
+# pages read. Counts only grow, so a product's new top pairs are among its
+# old ones and the pairs counted in the batch, and only those are ranked.
+# Changing RECOMMENDATIONS_PER_PRODUCT needs a --rebuild.
+def build_recommendations(conn, batch_size):
+    c = conn.cursor()
+    c.execute("SELECT high_water FROM rollup_state WHERE name = 'co_purchases'")
+    high_water = c.fetchone()[0]
+    c.execute("SELECT MAX(id) FROM (SELECT id FROM orders WHERE id > ? ORDER BY id LIMIT ?)",
+              (high_water, batch_size))
+    through = c.fetchone()[0]
+    if through is None:
+        return high_water
+    
+    c.execute('''CREATE TEMP TABLE IF NOT EXISTS batch_pairs
+                 (product_id INTEGER NOT NULL,
+                  other_id INTEGER NOT NULL,
+                  orders INTEGER NOT NULL,
+                  PRIMARY KEY (product_id, other_id)) WITHOUT ROWID''')
+    c.execute("DELETE FROM batch_pairs")
+    c.execute('''INSERT INTO batch_pairs (product_id, other_id, orders)
+                 SELECT a.product_id, b.product_id, COUNT(DISTINCT a.order_id)
+                 FROM order_items a JOIN order_items b
+                   ON b.order_id = a.order_id AND b.product_id != a.product_id
+                 WHERE a.order_id > ? AND a.order_id <= ?
+                 GROUP BY a.product_id, b.product_id''', (high_water, through))
+    c.execute('''INSERT INTO product_pairs (product_id, other_id, orders)
+                 SELECT product_id, other_id, orders FROM batch_pairs WHERE true
+                 ON CONFLICT (product_id, other_id) DO UPDATE SET orders = orders + excluded.orders''')
+    
+    c.execute('''CREATE TEMP TABLE IF NOT EXISTS ranked_pairs
+                 (product_id INTEGER NOT NULL,
+                  rank INTEGER NOT NULL,
+                  other_id INTEGER NOT NULL,
+                  orders INTEGER NOT NULL)''')
+    c.execute("DELETE FROM ranked_pairs")
+    c.execute('''INSERT INTO ranked_pairs (product_id, rank, other_id, orders)
+                 SELECT product_id, rank, other_id, orders FROM
+                     (SELECT pp.product_id, pp.other_id, pp.orders,
+                             ROW_NUMBER() OVER (PARTITION BY pp.product_id
+                                                ORDER BY pp.orders DESC, pp.other_id) AS rank
+                      FROM (SELECT product_id, other_id FROM batch_pairs
+                            UNION
+                            SELECT product_id, other_id FROM product_recommendations
+                            WHERE product_id IN (SELECT product_id FROM batch_pairs)) candidates
+                      JOIN product_pairs pp
+                        ON pp.product_id = candidates.product_id AND pp.other_id = candidates.other_id)
+                 WHERE rank <= ?''', (app.config['RECOMMENDATIONS_PER_PRODUCT'],))
+    c.execute('''DELETE FROM product_recommendations
+                 WHERE product_id IN (SELECT product_id FROM batch_pairs)''')
+    c.execute('''INSERT INTO product_recommendations (product_id, rank, other_id, orders)
+                 SELECT product_id, rank, other_id, orders FROM ranked_pairs''')
+    c.execute("UPDATE rollup_state SET high_water = ? WHERE name = 'co_purchases'", (through,))
+    return through
+
+# Builds from every order placed so far, a batch per write transaction
+def catch_up_recommendations(conn):
+    batch_size = app.config['RECOMMENDATIONS_BATCH_SIZE']
+    high_water = None
+    while True:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            previous, high_water = high_water, build_recommendations(conn, batch_size)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        if high_water == previous:
+            recommendation_cache.invalidate()
+            return high_water
+
+@periodic_job('build_recommendations', 'RECOMMENDATIONS_INTERVAL')
+def build_recommendations_job(payload):
+    catch_up_recommendations(get_db())
+
+@app.cli.command('build-recommendations')
+@click.option('--rebuild', is_flag=True, help='Start again from the first order')
+def build_recommendations_command(rebuild):
+    init_db_once()
+    conn = connect_db()
+    if rebuild:
+        conn.execute("DELETE FROM product_pairs")
+        conn.execute("DELETE FROM product_recommendations")
+        conn.execute("UPDATE rollup_state SET high_water = 0 WHERE name = 'co_purchases'")
+        conn.commit()
+    high_water = catch_up_recommendations(conn)
+    conn.close()
+    print(f'Recommendations built through order {high_water}')
+
+# Recommendations for a product or a cart, kept for
+# RECOMMENDATION_CACHE_TTL seconds and least recently used first out once
+# there are RECOMMENDATION_CACHE_SIZE of them
+class RecommendationCache:
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, loader, ttl, max_entries):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() < entry[0]:
+                self._entries.move_to_end(key)
+                return entry[1]
+            generation = self._generation
+        
+        data = loader()
+        with self._lock:
+            # Don't store a result that raced with an invalidation
+            if generation == self._generation:
+                self._entries[key] = (time.monotonic() + ttl, data)
+                self._entries.move_to_end(key)
+                while len(self._entries) > max_entries:
+                    self._entries.popitem(last=False)
+        return data
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+recommendation_cache = RecommendationCache()
+
+# In-stock products most often bought with product_ids, best first, leaving
+# out product_ids themselves. For several products (a cart) their counts
+# are added up; a single product reads its list in rank order.
+def load_recommendations(product_ids, limit):
+    c = get_read_db().cursor()
+    if len(product_ids) == 1:
+        c.execute('''SELECT p.id, p.name, p.price, p.image, p.category, p.stock, r.orders
+                     FROM product_recommendations r JOIN products p ON p.id = r.other_id
+                     WHERE r.product_id = ? AND p.stock > 0
+                     ORDER BY r.rank LIMIT ?''', (product_ids[0], limit))
+        return [dict(row) for row in c.fetchall()]
+    placeholders = ','.join(['?'] * len(product_ids))
+    c.execute(f'''SELECT p.id, p.name, p.price, p.image, p.category, p.stock,
+                         SUM(r.orders) AS orders
+                  FROM product_recommendations r JOIN products p ON p.id = r.other_id
+                  WHERE r.product_id IN ({placeholders}) AND r.other_id NOT IN ({placeholders})
+                    AND p.stock > 0
+                  GROUP BY p.id ORDER BY orders DESC, p.id LIMIT ?''',
+              [*product_ids, *product_ids, limit])
+    return [dict(row) for row in c.fetchall()]
+
+def get_recommendations(product_ids):
+    key = tuple(sorted(int(product_id) for product_id in product_ids))
+    if not key:
+        return []
+    return recommendation_cache.get(key, lambda: load_recommendations(key, app.config['RECOMMENDATIONS_SHOWN']),
+                                    app.config['RECOMMENDATION_CACHE_TTL'],
+                                    app.config['RECOMMENDATION_CACHE_SIZE'])
+
+class OutOfStockError(Exception):
+    def __init__(self, product):
+        super().__init__(f'Not enough stock for {product}')
+        self.product = product
+
+# Creates an order for a cart ({product_id: quantity}) in one write
+# transaction and returns its id. BEGIN IMMEDIATE takes the write lock
+# before stock is read, and the conditional UPDATE can't take stock below
+# zero, so concurrent buyers of the last units can't oversell. Other carts'
+# holds count against the stock; the buyer's own holds (holder) are
+# released in the same transaction.
+def place_order(conn, user_id, cart, payment_method, shipping_address, holder=None):
+    c = conn.cursor()
     
-    query = "SELECT * FROM products WHERE 1=1"
-    params = []
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        pricing = price_cart(conn, cart, holder)
+        if pricing['missing']:
+            raise OutOfStockError(pricing['missing'][0])
+        for item in pricing['items']:
+            if not item['in_stock']:
+                raise OutOfStockError(item['name'])
+        
+        order_date = datetime.now().isoformat()
+        c.execute('''INSERT INTO orders 
+                     (user_id, order_date, total, payment_method, shipping_address,
+                      item_count, item_quantity) 
+                     VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                  (user_id, order_date, pricing['total'], payment_method, shipping_address,
+                   len(pricing['items']), sum(item['quantity'] for item in pricing['items'])))
+        order_id = c.lastrowid
+        
+        c.executemany('''INSERT INTO order_items 
+                         (order_id, product_id, quantity, price) 
+                         VALUES (?, ?, ?, ?)''',
+                      [(order_id, item['id'], item['quantity'], item['price'])
+                       for item in pricing['items']])
+        
+        for item in pricing['items']:
+            c.execute("UPDATE products SET stock = stock - ? WHERE id = ? AND stock >= ?",
+                      (item['quantity'], item['id'], item['quantity']))
+            if c.rowcount != 1:
+                raise OutOfStockError(item['name'])
+            if item['stock'] - item['quantity'] <= app.config['LOW_STOCK_THRESHOLD']:
+                # One alert per product a day
+                enqueue_job(conn, 'low_stock', {'product_id': item['id']},
+                            key=f"low-stock-{item['id']}-{order_date[:10]}")
+        
+        if holder is not None:
+            c.execute("DELETE FROM stock_holds WHERE holder = ?", (holder,))
+        
+        if roll_up_sales(conn, app.config['ROLLUP_INLINE_ORDERS']) < order_id:
+            enqueue_job(conn, 'roll_up_sales', {}, key=f'roll-up-sales-{order_id}')
+        
+        enqueue_job(conn, 'order_placed', {'order_id': order_id}, key=f'order-placed-{order_id}')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return order_id
+
+# Product listing sorts: the key columns (SQL expression, row column) used
+# for ORDER BY and keyset pagination, and their direction. Every sort ends
+# in p.id so cursors are stable across equal names and prices. For
+# relevance, name hits outrank category hits, which outrank description hits.
+RELEVANCE = 'bm25(products_fts, 10.0, 1.0, 4.0)'
+PRODUCT_SORTS = {
+    'name': ([('p.name', 'name'), ('p.id', 'id')], 'ASC'),
+    'price_asc': ([('p.price', 'price'), ('p.id', 'id')], 'ASC'),
+    'price_desc': ([('p.price', 'price'), ('p.id', 'id')], 'DESC'),
+    'newest': ([('p.id', 'id')], 'DESC'),
+    'rating': ([('p.rating_avg', 'rating_avg'), ('p.id', 'id')], 'DESC'),
+    'relevance': ([(RELEVANCE, 'relevance'), ('p.id', 'id')], 'ASC'),
+}
+
+# Order history, newest first
+ORDER_SORTS = {
+    'newest': ([('o.order_date', 'order_date'), ('o.id', 'id')], 'DESC'),
+}
+
+# The type a cursor value must have for each sort key column
+CURSOR_TYPES = {
+    'id': int,
+    'name': str,
+    'order_date': str,
+    'price': float,
+    'rating_avg': float,
+    'relevance': float,
+}
+
+# Queries of the order and review routes, shared with the query plan
+# checks in bench.py
+def build_order_history_query(user_id, after, limit):
+    query = '''SELECT o.*, 
+               COALESCE(o.item_count,
+                        (SELECT COUNT(*) FROM order_items oi WHERE oi.order_id = o.id)) as item_count,
+               COALESCE(o.item_quantity,
+                        (SELECT SUM(quantity) FROM order_items oi WHERE oi.order_id = o.id)) as item_quantity
+               FROM orders o
+               WHERE o.user_id = ?'''
+    params = [user_id]
+    position = decode_cursor('newest', after, ORDER_SORTS) if after else None
+    if position:
+        query += " AND (o.order_date, o.id) < (?, ?)"
+        params.extend(position)
+    query += " ORDER BY o.order_date DESC, o.id DESC LIMIT ?"
+    params.append(limit)
+    return query, params
+
+ORDER_QUERY = '''SELECT o.*, 
+                 COALESCE(o.item_count,
+                          (SELECT COUNT(*) FROM order_items oi WHERE oi.order_id = o.id)) as item_count
+                 FROM orders o 
+                 WHERE o.id = ? AND o.user_id = ?'''
+
+ORDER_ITEMS_QUERY = '''SELECT oi.*, p.name, p.image 
+                       FROM order_items oi 
+                       JOIN products p ON oi.product_id = p.id 
+                       WHERE oi.order_id = ?'''
+
+PRODUCT_REVIEWS_QUERY = '''SELECT reviews.*, users.username 
+                           FROM reviews 
+                           JOIN users ON reviews.user_id = users.id 
+                           WHERE product_id = ? 
+                           ORDER BY review_date DESC'''
+
+REVIEW_PURCHASED_QUERY = '''SELECT 1 FROM order_items oi
+                            JOIN orders o ON oi.order_id = o.id
+                            WHERE o.user_id = ? AND oi.product_id = ?'''
+
+REVIEW_EXISTS_QUERY = '''SELECT 1 FROM reviews 
+                         WHERE user_id = ? AND product_id = ?'''
+
+def encode_cursor(sort, row, sorts=PRODUCT_SORTS):
+    keys, direction = sorts[sort]
+    payload = json.dumps([sort] + [row[column] for _, column in keys])
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+def decode_cursor(sort, cursor, sorts=PRODUCT_SORTS):
+    # Cursors that are malformed or were issued for another sort are ignored
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        return None
+    keys, direction = sorts[sort]
+    if not isinstance(values, list) or len(values) != len(keys) + 1 or values[0] != sort:
+        return None
+    for (_, column), value in zip(keys, values[1:]):
+        if not is_cursor_value(value, CURSOR_TYPES[column]):
+            return None
+    return values[1:]
+
+def is_cursor_value(value, kind):
+    if isinstance(value, bool):
+        return False
+    if kind is float:
+        return isinstance(value, (int, float)) and math.isfinite(value)
+    return isinstance(value, kind)
+
+def get_page_size(args):
+    try:
+        page_size = int(args.get('page_size', app.config['PRODUCTS_PER_PAGE']))
+    except ValueError:
+        page_size = app.config['PRODUCTS_PER_PAGE']
+    return max(1, min(page_size, app.config['MAX_PRODUCTS_PER_PAGE']))
+
+# Price and rating filters that are not numbers are ignored, like a bad
+# page_size or cursor
+def get_number_filter(args, name):
+    try:
+        value = float(args.get(name) or 'nan')
+    except ValueError:
+        return None
+    return value if math.isfinite(value) else None
+
+# Builds the product listing query for home() from its query args.
+# Returns the query, its params and the effective sort; pass a cursor from
+# encode_cursor() as after to continue from the last row of a page.
+def build_product_query(args, after=None, limit=None):
+    category = args.get('category')
+    search = args.get('search')
+    min_price = get_number_filter(args, 'min_price')
+    max_price = get_number_filter(args, 'max_price')
+    min_rating = get_number_filter(args, 'min_rating')
+    
+    match = None
+    if search and app.config['SEARCH_FTS']:
+        match = search_match_expression(search)
+    sort = args.get('sort', 'relevance' if match else 'name')
+    if sort not in PRODUCT_SORTS or (sort == 'relevance' and not match):
+        sort = 'name'
+    
+    if match:
+        query = '''SELECT p.*, {} AS relevance FROM products_fts
+                   JOIN products p ON p.id = products_fts.rowid
+                   WHERE products_fts MATCH ?'''.format(RELEVANCE)
+        params = [match]
+    else:
+        query = "SELECT p.* FROM products p WHERE 1=1"
+        params = []
     
     if category and category != 'all':
-        query += " AND category = ?"
+        query += " AND p.category = ?"
         params.append(category)
     
-    if search:
-        query += " AND (name LIKE ? OR description LIKE ?)"
+    if search and not match:
+        query += " AND (p.name LIKE ? OR p.description LIKE ?)"
         params.extend([f"%{search}%", f"%{search}%"])
     
-    if min_price:
-        query += " AND price >= ?"
-        params.append(float(min_price))
+    if min_price is not None:
+        query += " AND p.price >= ?"
+        params.append(min_price)
     
-    if max_price:
-        query += " AND price <= ?"
-        params.append(float(max_price))
+    if max_price is not None:
+        query += " AND p.price <= ?"
+        params.append(max_price)
     
-    if sort == 'price_asc':
-        query += " ORDER BY price ASC"
-    elif sort == 'price_desc':
-        query += " ORDER BY price DESC"
-    elif sort == 'newest':
-        query += " ORDER BY id DESC"
-    else:
-        query += " ORDER BY name"
+    if min_rating is not None:
+        query += " AND p.rating_avg >= ?"
+        params.append(min_rating)
     
-    c.execute(query, params)
-    products = c.fetchall()
+    keys, direction = PRODUCT_SORTS[sort]
+    columns = [expression for expression, _ in keys]
     
-    c.execute("SELECT DISTINCT category FROM products WHERE category IS NOT NULL")
-    categories = [row['category'] for row in c.fetchall()]
+    values = decode_cursor(sort, after) if after else None
+    if values is not None:
+        operator = '>' if direction == 'ASC' else '<'
+        if len(columns) == 1:
+            query += f" AND {columns[0]} {operator} ?"
+        else:
+            query += " AND ({}) {} ({})".format(', '.join(columns), operator,
+                                                ', '.join('?' * len(columns)))
+        params.extend(values)
     
-    conn.close()
+    query += " ORDER BY " + ', '.join(f"{column} {direction}" for column in columns)
     
-    return render_template('home.html', 
-                         products=products, 
-                         categories=categories,
-                         cart_size=len(get_cart()))
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+    
+    return query, params, sort
+
+# In-process catalog index for listings without a search term, enabled with
+# CATALOG_INDEX. Products are held column-wise in arrays, and every sort
+# is kept presorted as a list of key tuples for the whole catalog and for
+# each category. A page is then a bisect to the cursor and a scan past the
+# rows that the price and rating filters reject; price sorts also bisect to
+# the price range. Only the rows on the page are fetched, by id. Each
+# process applies the products logged in product_changes at most every
+# CATALOG_INDEX_REFRESH seconds, and reloads when too much has changed.
+# It is off by default: listings that SQL serves from an index are as fast
+# or faster without it (about 0.08 ms against 0.10 ms per page at 50,000
+# products), and it only wins when a filter makes SQL scan, such as a
+# rating floor within a category (6.6 ms against 0.11 ms).
+class CatalogIndex:
+    # Reload instead of patching when more than this share of rows changed
+    RELOAD_RATIO = 0.25
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.loaded = False
+        self.seq = 0
+        self.checked = 0
+
+    def refresh(self, conn, interval):
+        if self.loaded and time.monotonic() - self.checked < interval:
+            return
+        with self._lock:
+            if self.loaded and time.monotonic() - self.checked < interval:
+                return
+            self.checked = time.monotonic()
+            c = conn.cursor()
+            if self.loaded:
+                c.execute("SELECT MIN(seq) FROM product_changes")
+                oldest = c.fetchone()[0]
+                c.execute("SELECT seq, product_id FROM product_changes WHERE seq > ? ORDER BY seq",
+                          (self.seq,))
+                changes = c.fetchall()
+                changed = list(dict.fromkeys(row['product_id'] for row in changes))
+                pruned = oldest is not None and oldest > self.seq + 1
+                if not pruned and len(changed) <= len(self.positions) * self.RELOAD_RATIO:
+                    if changes:
+                        self._apply(c, changed)
+                        self.seq = changes[-1]['seq']
+                    return
+            self._load(c)
+
+    def _load(self, c):
+        c.execute("SELECT COALESCE(MAX(seq), 0) FROM product_changes")
+        self.seq = c.fetchone()[0]
+        self.ids = array('q')
+        self.prices = array('d')
+        self.ratings = array('d')
+        self.category_codes = array('H')
+        self.names = []
+        self.positions = {}
+        # Code 0 is for products without a category
+        self.categories = {None: 0}
+        self.sorted = {}
+        
+        c.execute("SELECT id, name, price, category, rating_avg FROM products")
+        for row in c.fetchall():
+            self._store(row)
+        for columns in self.sort_columns():
+            keys = sorted(self._key(columns, pos) for pos in self.positions.values())
+            self.sorted[columns, None] = keys
+            for key in keys:
+                category = self.category_codes[self.positions[key[-1]]]
+                self.sorted.setdefault((columns, category), []).append(key)
+        self.loaded = True
+
+    def _apply(self, c, product_ids):
+        rows = {}
+        for start in range(0, len(product_ids), 500):
+            chunk = product_ids[start:start + 500]
+            c.execute("SELECT id, name, price, category, rating_avg FROM products WHERE id IN ({})"
+                      .format(','.join(['?'] * len(chunk))), chunk)
+            rows.update((row['id'], row) for row in c.fetchall())
+        
+        sorts = self.sort_columns()
+        for product_id in product_ids:
+            pos = self.positions.pop(product_id, None)
+            if pos is not None:
+                for columns in sorts:
+                    self._unsort(columns, pos)
+            row = rows.get(product_id)
+            if row is not None:
+                pos = self._store(row, pos)
+                for columns in sorts:
+                    key = self._key(columns, pos)
+                    bisect.insort(self.sorted[columns, None], key)
+                    bisect.insort(self.sorted.setdefault((columns, self.category_codes[pos]), []), key)
+
+    def _store(self, row, pos=None):
+        category = self.categories.setdefault(row['category'], len(self.categories))
+        values = (row['id'], row['price'], row['rating_avg'], category, row['name'])
+        columns = (self.ids, self.prices, self.ratings, self.category_codes, self.names)
+        if pos is None:
+            pos = len(self.ids)
+            for column, value in zip(columns, values):
+                column.append(value)
+        else:
+            for column, value in zip(columns, values):
+                column[pos] = value
+        self.positions[row['id']] = pos
+        return pos
+
+    def _unsort(self, columns, pos):
+        key = self._key(columns, pos)
+        for keys in (self.sorted[columns, None], self.sorted[columns, self.category_codes[pos]]):
+            index = bisect.bisect_left(keys, key)
+            if index < len(keys) and keys[index] == key:
+                del keys[index]
+
+    def _key(self, columns, pos):
+        values = {'id': self.ids[pos], 'name': self.names[pos], 'price': self.prices[pos],
+                  'rating_avg': self.ratings[pos]}
+        return tuple(values[column] for column in columns)
+    
+    # The key columns of each sort; ascending and descending sorts share
+    # one list
+    @staticmethod
+    def sort_columns():
+        return {tuple(column for _, column in keys)
+                for sort, (keys, direction) in PRODUCT_SORTS.items() if sort != 'relevance'}
+    
+    # Ids of the listing page for home()'s query args, in order, like
+    # build_product_query() without a search term
+    def page(self, args, after=None, limit=None):
+        sort = args.get('sort', 'name')
+        if sort not in PRODUCT_SORTS or sort == 'relevance':
+            sort = 'name'
+        keys, direction = PRODUCT_SORTS[sort]
+        columns = tuple(column for _, column in keys)
+        min_price = get_number_filter(args, 'min_price')
+        max_price = get_number_filter(args, 'max_price')
+        min_rating = get_number_filter(args, 'min_rating')
+        category = args.get('category')
+        
+        with self._lock:
+            if category and category != 'all':
+                code = self.categories.get(category)
+                if code is None:
+                    return [], sort
+                keys = self.sorted.get((columns, code), [])
+            else:
+                keys = self.sorted[columns, None]
+            
+            values = decode_cursor(sort, after) if after else None
+            by_price = columns[0] == 'price'
+            if direction == 'ASC':
+                start = bisect.bisect_right(keys, tuple(values)) if values is not None else 0
+                if by_price and min_price is not None:
+                    start = max(start, bisect.bisect_left(keys, (min_price,)))
+                indexes = range(start, len(keys))
+            else:
+                end = bisect.bisect_left(keys, tuple(values)) if values is not None else len(keys)
+                if by_price and max_price is not None:
+                    end = min(end, bisect.bisect_right(keys, (max_price, float('inf'))))
+                indexes = range(end - 1, -1, -1)
+            
+            ids = []
+            for index in indexes:
+                product_id = keys[index][-1]
+                pos = self.positions[product_id]
+                price = self.prices[pos]
+                if max_price is not None and price > max_price:
+                    if by_price:
+                        break
+                    continue
+                if min_price is not None and price < min_price:
+                    if by_price:
+                        break
+                    continue
+                if min_rating is not None and self.ratings[pos] < min_rating:
+                    continue
+                ids.append(product_id)
+                if limit is not None and len(ids) >= limit:
+                    break
+        return ids, sort
+
+catalog_index = CatalogIndex()
+
+# Drops changes logged more than retention seconds ago. An index that is
+# serving applies changes within CATALOG_INDEX_REFRESH, so these have been
+# applied; one idle for longer finds the gap and reloads. The newest entry
+# stays, so an index that fell behind the pruned range can tell.
+def prune_product_changes(conn, retention):
+    cutoff = (datetime.now() - timedelta(seconds=retention)).isoformat()
+    c = conn.cursor()
+    c.execute('''DELETE FROM product_changes
+                 WHERE changed_at < ? AND seq < (SELECT MAX(seq) FROM product_changes)''', (cutoff,))
+    conn.commit()
+    return c.rowcount
+
+@periodic_job('prune_product_changes', 'PRODUCT_CHANGES_PRUNE_INTERVAL')
+def prune_product_changes_job(payload):
+    prune_product_changes(get_db(), app.config['PRODUCT_CHANGES_RETENTION'])
+
+# The listing page from the catalog index, or None when it can't serve
+# the query (searches go to SQL). Returns the rows and the effective sort.
+def catalog_index_page(conn, args, after=None, limit=None):
+    if not app.config['CATALOG_INDEX'] or args.get('search'):
+        return None
+    catalog_index.refresh(conn, app.config['CATALOG_INDEX_REFRESH'])
+    ids, sort = catalog_index.page(args, after, limit)
+    if not ids:
+        return [], sort
+    c = conn.cursor()
+    c.execute("SELECT * FROM products WHERE id IN ({})".format(','.join(['?'] * len(ids))), ids)
+    rows = {row['id']: row for row in c.fetchall()}
+    return [rows[product_id] for product_id in ids if product_id in rows], sort
+
+# Renders a template as a stream so the page head goes out before the body
+# is built. Flashes are read up front because the session cookie is sent
+# with the headers, before the template would consume them.
+def stream_page(template_name, **context):
+    get_flashed_messages(with_categories=True)
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(app.config['TEMPLATE_STREAM_BUFFER'])
+    return Response(stream_with_context(stream))
+
+# Routes
+@app.route('/')
+@cached_page
+def home():
+    conn = get_read_db()
+    c = conn.cursor()
+    
+    page_size = get_page_size(request.args)
+    page = catalog_index_page(conn, request.args, after=request.args.get('after'), limit=page_size + 1)
+    if page is not None:
+        products, sort = page
+    else:
+        query, params, sort = build_product_query(request.args,
+                                                  after=request.args.get('after'),
+                                                  limit=page_size + 1)
+        c.execute(query, params)
+        products = c.fetchall()
+    
+    next_url = None
+    if len(products) > page_size:
+        products = products[:page_size]
+        args = request.args.to_dict()
+        args['after'] = encode_cursor(sort, products[-1])
+        next_url = url_for('home', **args)
+    
+    first_url = None
+    if request.args.get('after'):
+        args = request.args.to_dict()
+        args.pop('after')
+        first_url = url_for('home', **args)
+    
+    return stream_page('home.html', 
+                       products=products, 
+                       next_url=next_url,
+                       first_url=first_url,
+                       cart_size=len(get_cart()))
 
 @app.route('/product/<int:product_id>')
+@cached_page
 def product_detail(product_id):
-    conn = get_db()
+    conn = get_read_db()
     c = conn.cursor()
     
     c.execute("SELECT * FROM products WHERE id = ?", (product_id,))
@@ -197,43 +2757,33 @@ def product_detail(product_id):
         flash('Product not found', 'error')
         return redirect(url_for('home'))
     
-    c.execute('''SELECT reviews.*, users.username 
-                 FROM reviews 
-                 JOIN users ON reviews.user_id = users.id 
-                 WHERE product_id = ? 
-                 ORDER BY review_date DESC''', (product_id,))
+    c.execute(PRODUCT_REVIEWS_QUERY, (product_id,))
     reviews = c.fetchall()
     
-    c.execute("SELECT AVG(rating) FROM reviews WHERE product_id = ?", (product_id,))
-    avg_rating = c.fetchone()[0] or 0
-    
-    conn.close()
-    
+    # product_detail.html is not in the tree; recommendations are passed for
+    # it like cart.html gets them
     return render_template('product_detail.html', 
                          product=product, 
                          reviews=reviews, 
-                         avg_rating=round(avg_rating, 1),
+                         avg_rating=round(product['rating_avg'], 1),
+                         recommendations=get_recommendations([product_id]),
                          cart_size=len(get_cart()))
 
 @app.route('/add_to_cart/<int:product_id>', methods=['POST'])
 def add_to_cart(product_id):
     quantity = int(request.form.get('quantity', 1))
     
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT stock FROM products WHERE id = ?", (product_id,))
-    stock = c.fetchone()[0]
-    conn.close()
-    
     cart = get_cart()
     current_quantity = cart.get(str(product_id), 0)
     
-    if current_quantity + quantity > stock:
-        flash(f'Only {stock} available in stock', 'error')
+    short = hold_stock(get_db(), cart_holder(create=True),
+                       {str(product_id): current_quantity + quantity})
+    if short:
+        flash(f'Only {short[0][1]} available in stock', 'error')
         return redirect(request.referrer or url_for('home'))
     
     cart[str(product_id)] = current_quantity + quantity
-    session['cart'] = cart
+    save_cart(cart)
     
     flash('Product added to cart', 'success')
     return redirect(request.referrer or url_for('home'))
@@ -242,14 +2792,9 @@ def add_to_cart(product_id):
 def update_cart(product_id):
     quantity = int(request.form.get('quantity', 1))
     
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT stock FROM products WHERE id = ?", (product_id,))
-    stock = c.fetchone()[0]
-    conn.close()
-    
-    if quantity > stock:
-        flash(f'Only {stock} available in stock', 'error')
+    short = hold_stock(get_db(), cart_holder(create=True), {str(product_id): max(quantity, 0)})
+    if short:
+        flash(f'Only {short[0][1]} available in stock', 'error')
         return redirect(url_for('view_cart'))
     
     cart = get_cart()
@@ -257,28 +2802,67 @@ def update_cart(product_id):
         cart.pop(str(product_id), None)
     else:
         cart[str(product_id)] = quantity
-    session['cart'] = cart
+    save_cart(cart)
+    
+    flash('Cart updated', 'success')
+    return redirect(url_for('view_cart'))
+
+# Applies every quantity-<product_id> field of the form in one go. Stock for
+# all of them is held in one transaction, and nothing changes unless every
+# line fits.
+@app.route('/update_cart', methods=['POST'])
+def update_cart_batch():
+    changes = {}
+    for name, value in request.form.items():
+        if name.startswith('quantity-'):
+            try:
+                changes[str(int(name[len('quantity-'):]))] = int(value)
+            except ValueError:
+                flash('Invalid quantity', 'error')
+                return redirect(url_for('view_cart'))
+    
+    if not changes:
+        return redirect(url_for('view_cart'))
+    
+    short = hold_stock(get_db(), cart_holder(create=True),
+                       {product_id: max(quantity, 0) for product_id, quantity in changes.items()})
+    if short:
+        flash('Not enough stock for ' + ', '.join(f'{name} (only {available} available)'
+                                                  for name, available in short), 'error')
+        return redirect(url_for('view_cart'))
+    
+    cart = dict(get_cart())
+    for product_id, quantity in changes.items():
+        if quantity > 0:
+            cart[product_id] = quantity
+        else:
+            cart.pop(product_id, None)
+    save_cart(cart)
     
     flash('Cart updated', 'success')
     return redirect(url_for('view_cart'))
 
 @app.route('/remove_from_cart/<int:product_id>')
 def remove_from_cart(product_id):
+    holder = cart_holder()
+    if holder is not None:
+        hold_stock(get_db(), holder, {str(product_id): 0})
+    
     cart = get_cart()
     cart.pop(str(product_id), None)
-    session['cart'] = cart
+    save_cart(cart)
     
     flash('Product removed from cart', 'success')
     return redirect(url_for('view_cart'))
 
 @app.route('/cart')
 def view_cart():
-    items = get_cart_items()
-    total = sum(item['subtotal'] for item in items)
+    pricing = get_cart_pricing()
     
     return render_template('cart.html', 
-                         items=items, 
-                         total=round(total, 2),
+                         items=pricing['items'], 
+                         total=pricing['total'],
+                         recommendations=get_recommendations(get_cart().keys()),
                          cart_size=len(get_cart()))
 
 @app.route('/checkout', methods=['GET', 'POST'])
@@ -296,7 +2880,6 @@ def checkout():
     c = conn.cursor()
     c.execute("SELECT * FROM users WHERE id = ?", (session['user_id'],))
     user = c.fetchone()
-    conn.close()
     
     if request.method == 'POST':
         payment_method = request.form.get('payment_method')
@@ -306,52 +2889,26 @@ def checkout():
             flash('Please select a payment method', 'error')
             return redirect(url_for('checkout'))
         
-        conn = get_db()
-        c = conn.cursor()
-        
         try:
-            # Check stock before processing order
-            for product_id, quantity in cart.items():
-                c.execute("SELECT stock FROM products WHERE id = ?", (product_id,))
-                stock = c.fetchone()[0]
-                if quantity > stock:
-                    flash(f'Not enough stock for {product_id}', 'error')
-                    return redirect(url_for('checkout'))
-            
-            # Create order
-            total = calculate_cart_total()
-            order_date = datetime.now().isoformat()
-            c.execute('''INSERT INTO orders 
-                         (user_id, order_date, total, payment_method, shipping_address) 
-                         VALUES (?, ?, ?, ?, ?)''',
-                      (session['user_id'], order_date, total, payment_method, shipping_address))
-            order_id = c.lastrowid
-            
-            # Add order items and update stock
-            for product_id, quantity in cart.items():
-                c.execute("SELECT price FROM products WHERE id = ?", (product_id,))
-                price = c.fetchone()[0]
-                c.execute('''INSERT INTO order_items 
-                            (order_id, product_id, quantity, price) 
-                            VALUES (?, ?, ?, ?)''',
-                          (order_id, product_id, quantity, price))
-                c.execute("UPDATE products SET stock = stock - ? WHERE id = ?", (quantity, product_id))
-            
-            # Clear cart
-            session.pop('cart', None)
-            
-            conn.commit()
-            flash('Order placed successfully!', 'success')
-            return redirect(url_for('order_confirmation', order_id=order_id))
-        except Exception as e:
-            conn.rollback()
+            order_id = place_order(get_db(), session['user_id'], cart,
+                                   payment_method, shipping_address, cart_holder())
+        except OutOfStockError as e:
+            flash(f'Not enough stock for {e.product}', 'error')
+            return redirect(url_for('checkout'))
+        except sqlite3.Error:
             flash('Error processing your order. Please try again.', 'error')
             return redirect(url_for('checkout'))
-        finally:
-            conn.close()
+        
+        invalidate_page_cache(cart.keys())
+        
+        # Clear cart
+        clear_cart()
+        
+        flash('Order placed successfully!', 'success')
+        return redirect(url_for('order_confirmation', order_id=order_id))
     
     return render_template('checkout.html', 
-                         total=calculate_cart_total(),
+                         total=get_cart_pricing()['total'],
                          user=user,
                          cart_size=len(get_cart()))
 
@@ -364,26 +2921,16 @@ def order_confirmation(order_id):
     conn = get_db()
     c = conn.cursor()
     
-    c.execute('''SELECT o.*, 
-                 COUNT(oi.id) as item_count 
-                 FROM orders o 
-                 JOIN order_items oi ON o.id = oi.order_id 
-                 WHERE o.id = ? AND o.user_id = ?
-                 GROUP BY o.id''', (order_id, session['user_id']))
+    c.execute(ORDER_QUERY, (order_id, session['user_id']))
     order = c.fetchone()
     
     if not order:
         flash('Order not found', 'error')
         return redirect(url_for('home'))
     
-    c.execute('''SELECT oi.*, p.name, p.image 
-                 FROM order_items oi 
-                 JOIN products p ON oi.product_id = p.id 
-                 WHERE oi.order_id = ?''', (order_id,))
+    c.execute(ORDER_ITEMS_QUERY, (order_id,))
     items = c.fetchall()
     
-    conn.close()
-    
     return render_template('order_confirmation.html', 
                          order=order, 
                          items=items,
@@ -398,19 +2945,20 @@ def view_orders():
     conn = get_db()
     c = conn.cursor()
     
-    c.execute('''SELECT o.*, 
-                 COUNT(oi.id) as item_count 
-                 FROM orders o 
-                 JOIN order_items oi ON o.id = oi.order_id 
-                 WHERE o.user_id = ? 
-                 GROUP BY o.id 
-                 ORDER BY o.order_date DESC''', (session['user_id'],))
+    page_size = app.config['ORDERS_PER_PAGE']
+    after = request.args.get('after')
+    c.execute(*build_order_history_query(session['user_id'], after, page_size + 1))
     orders = c.fetchall()
     
-    conn.close()
+    next_url = None
+    if len(orders) > page_size:
+        orders = orders[:page_size]
+        next_url = url_for('view_orders', after=encode_cursor('newest', orders[-1], ORDER_SORTS))
     
     return render_template('orders.html', 
                          orders=orders,
+                         next_url=next_url,
+                         first_url=url_for('view_orders') if after else None,
                          cart_size=len(get_cart()))
 
 @app.route('/order/<int:order_id>')
@@ -437,8 +2985,6 @@ def order_detail(order_id):
                  WHERE oi.order_id = ?''', (order_id,))
     items = c.fetchall()
     
-    conn.close()
-    
     return render_template('order_detail.html', 
                          order=order, 
                          items=items,
@@ -462,18 +3008,13 @@ def add_review(product_id):
     
     try:
         # Check if user has purchased this product
-        c.execute('''SELECT 1 FROM order_items oi
-                     JOIN orders o ON oi.order_id = o.id
-                     WHERE o.user_id = ? AND oi.product_id = ?''',
-                  (session['user_id'], product_id))
+        c.execute(REVIEW_PURCHASED_QUERY, (session['user_id'], product_id))
         if not c.fetchone():
             flash('You need to purchase this product before reviewing', 'error')
             return redirect(url_for('product_detail', product_id=product_id))
         
         # Check if user already reviewed this product
-        c.execute('''SELECT 1 FROM reviews 
-                     WHERE user_id = ? AND product_id = ?''',
-                  (session['user_id'], product_id))
+        c.execute(REVIEW_EXISTS_QUERY, (session['user_id'], product_id))
         if c.fetchone():
             flash('You have already reviewed this product', 'error')
             return redirect(url_for('product_detail', product_id=product_id))
@@ -486,12 +3027,11 @@ def add_review(product_id):
                   (product_id, session['user_id'], rating, comment, review_date))
         
         conn.commit()
+        invalidate_page_cache([product_id])
         flash('Review added successfully', 'success')
     except Exception as e:
         conn.rollback()
         flash('Error adding review', 'error')
-    finally:
-        conn.close()
     
     return redirect(url_for('product_detail', product_id=product_id))
 
@@ -508,11 +3048,15 @@ def register():
             flash('Username and password are required', 'error')
             return redirect(url_for('register'))
         
+        try:
+            hashed_password = run_hash(hash_password, password, app.config['PASSWORD_HASH_METHOD'])
+        except HashQueueFull:
+            return too_many_attempts('register.html', 1)
+        
         conn = get_db()
         c = conn.cursor()
         
         try:
-            hashed_password = generate_password_hash(password)
             c.execute('''INSERT INTO users 
                         (username, password, email, address, phone) 
                         VALUES (?, ?, ?, ?, ?)''',
@@ -524,8 +3068,6 @@ def register():
         except sqlite3.IntegrityError:
             flash('Username already exists', 'error')
             return redirect(url_for('register'))
-        finally:
-            conn.close()
     
     return render_template('register.html', cart_size=len(get_cart()))
 
@@ -535,14 +3077,34 @@ def login():
         username = request.form.get('username')
         password = request.form.get('password')
         
-        conn = get_db()
-        c = conn.cursor()
+        # Turned away before hashing while the username or the client
+        # address has had too many failed attempts
+        throttles = [(('user', username), app.config['LOGIN_USER_ATTEMPTS']),
+                     (('ip', request.remote_addr), app.config['LOGIN_IP_ATTEMPTS'])]
+        retry_after = max(login_throttle.retry_after(key, limit, app.config['LOGIN_THROTTLE_WINDOW'])
+                          for key, limit in throttles)
+        if retry_after:
+            return too_many_attempts('login.html', retry_after)
         
+        c = get_db().cursor()
         c.execute("SELECT * FROM users WHERE username = ?", (username,))
         user = c.fetchone()
-        conn.close()
         
-        if user and check_password_hash(user['password'], password):
+        valid, new_hash = False, None
+        if user:
+            try:
+                valid, new_hash = run_hash(verify_password, user['password'], password,
+                                           app.config['PASSWORD_HASH_METHOD'])
+            except HashQueueFull:
+                return too_many_attempts('login.html', 1)
+        
+        if valid:
+            if new_hash is not None:
+                # Hash settings changed since this password was stored
+                conn = get_db()
+                conn.execute("UPDATE users SET password = ? WHERE id = ?", (new_hash, user['id']))
+                conn.commit()
+            login_throttle.reset(('user', username))
             session['user_id'] = user['id']
             session['username'] = user['username']
             flash('Login successful', 'success')
@@ -550,6 +3112,8 @@ def login():
             next_page = request.args.get('next')
             return redirect(next_page or url_for('home'))
         else:
+            for key, limit in throttles:
+                login_throttle.record(key, limit, app.config['LOGIN_THROTTLE_KEYS'])
             flash('Invalid username or password', 'error')
             return redirect(url_for('login'))
     
@@ -557,6 +3121,7 @@ def login():
 
 @app.route('/logout')
 def logout():
+    clear_cart()
     session.clear()
     flash('You have been logged out', 'success')
     return redirect(url_for('home'))
@@ -568,7 +3133,12 @@ def contact():
         email = request.form.get('email')
         message = request.form.get('message')
         
-        # In a real app, you would send an email or save this to a database
+        # Keyed on the content, so a double submit is only sent once
+        key = hashlib.sha256(json.dumps([name, email, message]).encode()).hexdigest()
+        conn = get_db()
+        enqueue_job(conn, 'contact_message', {'name': name, 'email': email, 'message': message},
+                    key=f'contact-{key}')
+        conn.commit()
         flash('Thank you for your message! We will get back to you soon.', 'success')
         return redirect(url_for('contact'))
     
@@ -584,25 +3154,347 @@ def upload_file():
         flash('No selected file', 'error')
         return redirect(request.url)
     if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-        flash('Image uploaded successfully', 'success')
+        filename = store_upload(file)
+        flash(f'Image uploaded successfully as {filename}', 'success')
         return redirect(url_for('home'))
     return redirect(request.url)
 
+# ?size= picks a variant from IMAGE_VARIANTS, as WebP when the client
+# accepts it; the original is served until the variant has been built
 @app.route('/static/images/<filename>')
 def serve_image(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    folder = app.config['UPLOAD_FOLDER']
+    size = request.args.get('size')
+    
+    candidates = []
+    if size in app.config['IMAGE_VARIANTS'] and '.' in filename:
+        if 'image/webp' in request.accept_mimetypes.values():
+            candidates.append(image_variant_name(filename, size, 'webp'))
+        candidates.append(image_variant_name(filename, size))
+    candidates.append(filename)
+    
+    served = filename
+    for name in candidates:
+        path = safe_join(folder, name)
+        if path and os.path.isfile(path):
+            served = name
+            break
+    response = send_from_directory(folder, served)
+    if size:
+        response.vary.add('Accept')
+    
+    # Hashed names never change content, but a fallback to the original
+    # must not be pinned in place of the variant
+    if HASHED_IMAGE.match(filename.rsplit('.', 1)[0]) and (served != filename or len(candidates) == 1):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = 365 * 24 * 3600
+        response.cache_control.immutable = True
+    return response
+
+@app.route('/static/assets/<filename>')
+def serve_asset(filename):
+    if filename not in get_asset_manifest().values():
+        response = send_from_directory(app.config['ASSETS_SOURCE'], filename)
+        response.cache_control.no_cache = True
+        return response
+    
+    # The smallest precompressed copy the client accepts
+    folder = app.config['ASSETS_FOLDER']
+    served, encoding = filename, None
+    for name, suffix in ASSET_ENCODINGS:
+        path = safe_join(folder, filename + suffix)
+        if request.accept_encodings[name] and path and os.path.isfile(path):
+            served, encoding = filename + suffix, name
+            break
+    response = send_from_directory(folder, served, mimetype=mimetypes.guess_type(filename)[0])
+    if encoding is not None:
+        response.content_encoding = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = 365 * 24 * 3600
+    response.cache_control.immutable = True
+    return response
+
+# On-the-fly gzip for text responses of COMPRESSION_MIN_SIZE bytes or more,
+# for clients that accept it. Streamed pages are compressed as they go,
+# flushed after the first chunk so the browser still gets the head early
+# and then every COMPRESSION_FLUSH_SIZE bytes of page. The
+# ETag turns weak as the bytes on the wire differ from the page's.
+def should_compress(response):
+    if (not app.config['COMPRESSION'] or response.status_code != 200 or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in app.config['COMPRESSION_TYPES']):
+        return False
+    if not response.is_streamed and response.content_length < app.config['COMPRESSION_MIN_SIZE']:
+        return False
+    response.vary.add('Accept-Encoding')
+    return request.accept_encodings['gzip'] > 0
+
+def gzip_stream(chunks, level, flush_size):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    pending = flush_size
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            data = compressor.compress(chunk)
+            pending += len(chunk)
+            if pending >= flush_size:
+                data += compressor.flush(zlib.Z_SYNC_FLUSH)
+                pending = 0
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+@app.after_request
+def compress_response(response):
+    if not should_compress(response):
+        return response
+    if response.is_streamed:
+        response.response = gzip_stream(response.response, app.config['COMPRESSION_LEVEL'],
+                                        app.config['COMPRESSION_FLUSH_SIZE'])
+        response.headers.pop('Content-Length', None)
+    else:
+        body = g.pop('compressed_body', None)
+        if body is None:
+            body = gzip.compress(response.get_data(), app.config['COMPRESSION_LEVEL'])
+        response.set_data(body)
+    response.content_encoding = 'gzip'
+    etag, _ = response.get_etag()
+    if etag:
+        response.set_etag(etag, weak=True)
+    return response
+
+# Operator endpoints need their token as a bearer token. Without one they
+# are off, except for local requests in debug mode: behind a reverse proxy
+# on the same host every client looks local.
+def require_operator(token):
+    if not token:
+        if not app.debug or request.remote_addr not in ('127.0.0.1', '::1'):
+            abort(404)
+    elif not secrets.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        abort(403)
+
+# Prometheus scrape endpoint for the SQL_METRICS counters, guarded by
+# METRICS_TOKEN
+@app.route('/metrics')
+def metrics():
+    if not app.config['SQL_METRICS']:
+        abort(404)
+    require_operator(app.config['METRICS_TOKEN'])
+    stats = job_stats(get_db())
+    lines = ['# HELP store_jobs Jobs in the queue, by status.', '# TYPE store_jobs gauge']
+    lines += [f'store_jobs{{status="{status}"}} {count}' for status, count in sorted(stats['depth'].items())]
+    lines += ['# HELP store_job_oldest_due_seconds How long the oldest due job has waited.',
+              '# TYPE store_job_oldest_due_seconds gauge',
+              f"store_job_oldest_due_seconds {stats['oldest_due_seconds']}",
+              '# HELP store_job_latency_seconds Enqueue to completion over the last hour, by kind.',
+              '# TYPE store_job_latency_seconds gauge']
+    lines += [f'store_job_latency_seconds{{kind="{kind}"}} {row["avg_latency"]}'
+              for kind, row in stats['latency'].items()]
+    return Response(request_metrics.render() + '\n'.join(lines) + '\n',
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# Sales reports from the rollups, guarded by REPORTS_TOKEN:
+# ?by=day|category|product&start=YYYY-MM-DD&end=YYYY-MM-DD&limit=N, the
+# last 30 days by default. /reports/sales.csv is the same report as CSV.
+def sales_report_args():
+    by = request.args.get('by', 'day')
+    if by not in SALES_REPORTS:
+        abort(400)
+    try:
+        end = date.fromisoformat(request.args['end']) if request.args.get('end') else date.today()
+        start = (date.fromisoformat(request.args['start']) if request.args.get('start')
+                 else end - timedelta(days=29))
+        limit = int(request.args.get('limit', -1))
+    except ValueError:
+        abort(400)
+    return by, start.isoformat(), end.isoformat(), limit
+
+@app.route('/reports/sales')
+def sales_report_view():
+    require_operator(app.config['REPORTS_TOKEN'])
+    by, start, end, limit = sales_report_args()
+    conn = get_read_db()
+    c = conn.cursor()
+    c.execute("SELECT high_water FROM rollup_state WHERE name = 'sales'")
+    return jsonify(by=by, start=start, end=end, through_order=c.fetchone()[0],
+                   rows=sales_report(conn, by, start, end, limit))
+
+@app.route('/reports/sales.csv')
+def sales_report_csv():
+    require_operator(app.config['REPORTS_TOKEN'])
+    by, start, end, limit = sales_report_args()
+    rows = sales_report(get_read_db(), by, start, end, limit)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if rows:
+        writer.writerow([name for name in rows[0] if name != 'revenue_cents'])
+        writer.writerows([value for name, value in row.items() if name != 'revenue_cents'] for row in rows)
+    response = Response(buffer.getvalue(), content_type='text/csv; charset=utf-8')
+    response.headers['Content-Disposition'] = f'attachment; filename=sales-by-{by}-{start}-{end}.csv'
+    return response
 
 # Context processor to make categories available in all templates
 @app.context_processor
 def inject_categories():
-    conn = get_db()
+    catalog = get_catalog_meta()
+    return dict(categories=catalog['categories'], catalog=catalog)
+
+# Startup. create_app() applies config overrides, sets up the database once
+# under a file lock and warms the caches, so workers are ready before they
+# take traffic. WSGI servers can use it directly:
+#   gunicorn --workers 4 "app:create_app()"
+def create_app(config=None):
+    start = time.perf_counter()
+    if config:
+        app.config.update(config)
+    
+    timings = {}
+    phase = time.perf_counter()
+    init_db_once()
+    timings['init'] = time.perf_counter() - phase
+    
+    phase = time.perf_counter()
+    warm_caches()
+    timings['warmup'] = time.perf_counter() - phase
+    timings['total'] = time.perf_counter() - start
+    app.extensions['startup'] = timings
+    app.logger.info('Started in %.0fms (database %.0fms, warmup %.0fms)',
+                    timings['total'] * 1000, timings['init'] * 1000, timings['warmup'] * 1000)
+    return app
+
+# Serializes processes that set up the same database file
+@contextlib.contextmanager
+def database_lock(database):
+    with open(database + '.lock', 'a+b') as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        else:
+            lock_file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after 10 seconds
+                    pass
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+def schema_is_current(conn):
     c = conn.cursor()
-    c.execute("SELECT DISTINCT category FROM products WHERE category IS NOT NULL")
-    categories = [row['category'] for row in c.fetchall()]
-    conn.close()
-    return dict(categories=categories)
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    tables = {row['name'] for row in c.fetchall()}
+    if 'schema_version' not in tables:
+        return False
+    # init_db() also finds out whether FTS5 is available
+    if app.config['SEARCH_FTS'] and 'products_fts' not in tables:
+        return False
+    return get_schema_version(conn) >= max(version for version, _ in MIGRATIONS)
+
+# Creates, seeds and migrates the database unless another process already
+# has; workers that start together wait on the lock and then find it done
+def init_db_once():
+    database = app.config['DATABASE']
+    lock = database_lock(database) if database != ':memory:' else contextlib.nullcontext()
+    with lock:
+        conn = connect_db()
+        try:
+            current = schema_is_current(conn)
+        finally:
+            conn.close()
+        if not current:
+            init_db()
+        conn = connect_db()
+        try:
+            sync_product_change_log(conn)
+        finally:
+            conn.close()
+    app.extensions['db_ready'] = True
+
+def warm_caches():
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    # Loads the catalog metadata and puts the first catalog page in the
+    # page cache
+    app.test_client().get('/')
+    # Workers may be forked from this process, and sqlite connections must
+    # not cross a fork
+    get_pool().close()
+    if 'db_read_pool' in app.extensions:
+        app.extensions['db_read_pool'].close()
+
+_startup_lock = threading.Lock()
+
+# Servers that load app directly rather than through create_app(), such as
+# flask run, get the database set up on their first request
+@app.before_request
+def ensure_database():
+    if not app.extensions.get('db_ready'):
+        with _startup_lock:
+            if not app.extensions.get('db_ready'):
+                init_db_once()
+
+# Pre-fork server on werkzeug's WSGI server, which is built on the stdlib
+# socketserver. The parent binds the socket and starts up, then forks
+# workers that accept on the shared socket, each serving requests on
+# threads. Without os.fork (Windows) it serves from the one process.
+def serve(host, port, workers, threaded):
+    server = make_server(host, port, app, threaded=threaded)
+    if workers <= 1 or not hasattr(os, 'fork'):
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+        return
+    
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            server.serve_forever()
+            os._exit(0)
+        children.append(pid)
+    
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for pid in children:
+        os.waitpid(pid, 0)
+    server.server_close()
+
+@app.cli.command('serve')
+@click.option('--host', default='127.0.0.1')
+@click.option('--port', default=8000)
+@click.option('--workers', default=os.cpu_count() or 1, help='Worker processes')
+@click.option('--threaded/--no-threaded', default=True, help='Serve each worker\'s requests on threads')
+def serve_command(host, port, workers, threaded):
+    create_app()
+    startup = app.extensions['startup']
+    print(f"Started in {startup['total'] * 1000:.0f}ms (database {startup['init'] * 1000:.0f}ms, "
+          f"warmup {startup['warmup'] * 1000:.0f}ms)")
+    print(f'Serving on http://{host}:{port} with {workers} workers')
+    serve(host, port, workers, threaded)
 
 if __name__ == '__main__':
     # Create necessary directories
@@ -610,4 +3502,4 @@ if __name__ == '__main__':
     os.makedirs('static/images', exist_ok=True)
     
     # Run the app
-    app.run(debug=True)
\ No newline at end of file
+    create_app().run(debug=True)
\ No newline at end of file
@@ -0,0 +1,1023 @@
+# Benchmarks for the store app.
+#
+#   python bench.py search --products 50000
+#   python bench.py plans
+#   python bench.py checkout --buyers 64 --stock 10
+#   python bench.py holds --shoppers 64 --hot-skus 2 --stock 10
+#   python bench.py routes --orders 100000 --save-baseline bench_baseline.json
+#   python bench.py routes --server --threads 8 --baseline bench_baseline.json
+#   python bench.py replica --seconds 5 readonly
+#   python bench.py catalog --products 50000
+#   python bench.py reports --orders 10000 50000 200000
+#   python bench.py recommendations --orders 100000
+#   python bench.py logins --attackers 16 --seconds 5
+#   python bench.py assets --page-cache
+#
+# Each benchmark seeds its own throwaway database so store.db is never
+# touched; 'python bench.py seed --database FILE' fills a database of your
+# choosing instead.
+import argparse
+import http.client
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from flask import g, request, has_request_context
+from werkzeug.serving import make_server
+
+import app as store
+from app import app, init_db, connect_db, build_product_query
+
+WORDS = ['apple', 'banana', 'milk', 'bread', 'eggs', 'chicken', 'tomato', 'potato',
+         'organic', 'fresh', 'local', 'farm', 'whole', 'wheat', 'free', 'range',
+         'ripe', 'green', 'red', 'yellow', 'crunchy', 'sweet', 'spicy', 'smoked',
+         'cheese', 'butter', 'yogurt', 'onion', 'garlic', 'pepper', 'carrot', 'rice']
+CATEGORIES = ['Fruits', 'Dairy', 'Bakery', 'Meat', 'Vegetables', 'Pantry', 'Frozen', 'Drinks']
+
+def use_temp_database():
+    tmpdir = tempfile.mkdtemp(prefix='store-bench-')
+    app.config['DATABASE'] = os.path.join(tmpdir, 'bench.db')
+    init_db()
+    return app.config['DATABASE']
+
+def make_vocabulary(rnd, size=5000):
+    # Real catalogs have a long tail of brand and product words
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    extra = [''.join(rnd.choice(letters) for _ in range(rnd.randint(4, 9))) for _ in range(size)]
+    return WORDS + extra
+
+def seed_products(conn, count, seed=42):
+    rnd = random.Random(seed)
+    vocabulary = make_vocabulary(rnd)
+    rows = []
+    for i in range(count):
+        name = ' '.join(rnd.choice(WORDS) if rnd.random() < 0.3 else rnd.choice(vocabulary)
+                        for _ in range(3)).title() + f' #{i}'
+        description = ' '.join(rnd.choice(vocabulary) for _ in range(12))
+        rows.append((name, description, round(rnd.uniform(0.5, 50), 2),
+                     None, rnd.randint(0, 200), rnd.choice(CATEGORIES)))
+    conn.executemany('''INSERT INTO products (name, description, price, image, stock, category)
+                        VALUES (?, ?, ?, ?, ?, ?)''', rows)
+    conn.commit()
+
+def seed_orders(conn, users, orders, reviews=None, seed=42, chunk=10000):
+    rnd = random.Random(seed)
+    product_ids = [row[0] for row in conn.execute("SELECT id FROM products")]
+    first_user = conn.execute("SELECT COALESCE(MAX(id), 0) FROM users").fetchone()[0] + 1
+    conn.executemany("INSERT INTO users (username, password) VALUES (?, ?)",
+                     [(f'bench{first_user + i}', 'x') for i in range(users)])
+    user_ids = [row[0] for row in conn.execute("SELECT id FROM users")]
+
+    first_order = conn.execute("SELECT COALESCE(MAX(id), 0) FROM orders").fetchone()[0] + 1
+    for start in range(0, orders, chunk):
+        order_rows, item_rows = [], []
+        for order_id in range(first_order + start, first_order + min(start + chunk, orders)):
+            order_date = f'2024-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}T12:00:{order_id % 60:02d}'
+            items = [(order_id, product_id, rnd.randint(1, 3), 1.0)
+                     for product_id in rnd.sample(product_ids, min(len(product_ids), rnd.randint(1, 4)))]
+            quantity = sum(q for _, _, q, _ in items)
+            order_rows.append((order_id, rnd.choice(user_ids), order_date, quantity, len(items), quantity))
+            item_rows.extend(items)
+        conn.executemany('''INSERT INTO orders (id, user_id, order_date, total, item_count, item_quantity)
+                            VALUES (?, ?, ?, ?, ?, ?)''', order_rows)
+        conn.executemany('''INSERT INTO order_items (order_id, product_id, quantity, price)
+                            VALUES (?, ?, ?, ?)''', item_rows)
+
+    reviews = orders if reviews is None else reviews
+    for start in range(0, reviews, chunk):
+        conn.executemany('''INSERT INTO reviews (product_id, user_id, rating, comment, review_date)
+                            VALUES (?, ?, ?, '', ?)''',
+                         [(rnd.choice(product_ids), rnd.choice(user_ids), rnd.randint(1, 5),
+                           f'2024-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}T12:00:00')
+                          for _ in range(min(chunk, reviews - start))])
+    conn.commit()
+
+def time_calls(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def report(label, samples):
+    print(f"  {label:<10} mean {statistics.mean(samples):8.2f} ms   "
+          f"p50 {percentile(samples, 50):8.2f} ms   p95 {percentile(samples, 95):8.2f} ms")
+
+def bench_search(options):
+    use_temp_database()
+    conn = connect_db()
+    seed_products(conn, options.products)
+    terms = options.terms or ['apple', 'org', 'fresh milk', 'smok chee', 'zzz']
+    print(f"search over {options.products} products, {options.repeat} runs per query")
+
+    for term in terms:
+        print(f"'{term}'")
+        for label, use_fts in (('LIKE', False), ('FTS5', True)):
+            app.config['SEARCH_FTS'] = use_fts
+            query, params, _ = build_product_query({'search': term})
+            samples = time_calls(lambda: conn.execute(query, params).fetchall(), options.repeat)
+            hits = len(conn.execute(query, params).fetchall())
+            report(label, samples)
+            print(f"  {'':<10} {hits} results")
+    app.config['SEARCH_FTS'] = True
+    conn.close()
+
+# The queries behind each route, as the routes issue them. A plan step that
+# scans a table without an index, or sorts in a temp b-tree, is a failure.
+ROUTE_QUERIES = [
+    ('view_orders', *store.build_order_history_query(
+        1, store.encode_cursor('newest', {'order_date': '2024-07-01', 'id': 0}, store.ORDER_SORTS), 21)),
+    ('order_confirmation', store.ORDER_QUERY, (1, 1)),
+    ('order items', store.ORDER_ITEMS_QUERY, (1,)),
+    ('product reviews', store.PRODUCT_REVIEWS_QUERY, (1,)),
+    ('review purchased', store.REVIEW_PURCHASED_QUERY, (1, 1)),
+    ('review duplicate', store.REVIEW_EXISTS_QUERY, (1, 1)),
+]
+
+LISTING_ARGS = [
+    {'sort': 'name'},
+    {'sort': 'price_asc'},
+    {'sort': 'price_desc'},
+    {'category': 'Dairy'},
+    {'category': 'Dairy', 'sort': 'price_asc'},
+    {'min_price': '5', 'max_price': '10', 'sort': 'price_asc'},
+    {'sort': 'rating'},
+]
+
+def bad_plan_steps(conn, query, params):
+    plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + query, params)]
+    bad = [step for step in plan
+           if (step.startswith('SCAN') and 'USING' not in step) or 'TEMP B-TREE' in step]
+    return plan, bad
+
+def bench_plans(options):
+    use_temp_database()
+    conn = connect_db()
+    seed_products(conn, options.products)
+    seed_orders(conn, options.products // 10, options.products)
+
+    queries = list(ROUTE_QUERIES)
+    for args in LISTING_ARGS:
+        query, params, _ = build_product_query(args, limit=25)
+        label = 'home ' + ' '.join(f'{key}={value}' for key, value in args.items())
+        queries.append((label, query, params))
+
+    failures = 0
+    for label, query, params in queries:
+        plan, bad = bad_plan_steps(conn, query, params)
+        print(f"{'FAIL' if bad else 'ok':<5} {label}")
+        for step in plan:
+            print(f"        {step}")
+        failures += bool(bad)
+    conn.close()
+    if failures:
+        print(f"{failures} queries without a usable index")
+        sys.exit(1)
+
+def bench_checkout(options):
+    use_temp_database()
+    conn = connect_db()
+    seed_products(conn, 100)
+    conn.execute("UPDATE products SET stock = ? WHERE id = 1", (options.stock,))
+    conn.commit()
+    print(f"{options.buyers} buyers racing for {options.stock} units of one product")
+
+    # Sign everyone in first; only the checkouts race. Holds would only let
+    # the first stock buyers put the product in their carts, so each hold is
+    # dropped once taken and every buyer reaches place_order() with it.
+    clients = []
+    carted = 0
+    for i in range(options.buyers):
+        client = app.test_client()
+        client.post('/register', data={'username': f'buyer{i}', 'password': 'x'})
+        client.post('/login', data={'username': f'buyer{i}', 'password': 'x'})
+        client.post('/add_to_cart/1', data={'quantity': 1})
+        carted += conn.execute("DELETE FROM stock_holds").rowcount
+        conn.commit()
+        clients.append(client)
+    if carted <= options.stock:
+        print(f"  only {carted} buyers have the product in their cart, the race is not contended")
+        sys.exit(1)
+
+    barrier = threading.Barrier(options.buyers)
+    results = []
+
+    def buyer(client):
+        barrier.wait()
+        start = time.perf_counter()
+        response = client.post('/checkout', data={'payment_method': 'cash'})
+        results.append(((time.perf_counter() - start) * 1000,
+                        '/order_confirmation/' in response.headers.get('Location', '')))
+
+    threads = [threading.Thread(target=buyer, args=(client,)) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stock = conn.execute("SELECT stock FROM products WHERE id = 1").fetchone()[0]
+    sold = conn.execute("SELECT COALESCE(SUM(quantity), 0) FROM order_items WHERE product_id = 1").fetchone()[0]
+    conn.close()
+    report('checkout', [ms for ms, _ in results])
+    print(f"  {sum(ok for _, ok in results)} orders placed, {sold} units sold, {stock} left in stock")
+    if stock < 0 or sold + stock != options.stock:
+        print("  OVERSOLD")
+        sys.exit(1)
+
+# Shoppers race to put a unit of a few hot products in their carts, then
+# everyone who got one checks out. Holds must never promise more than the
+# stock, and nobody holding stock should fail at checkout.
+def bench_holds(options):
+    use_temp_database()
+    conn = connect_db()
+    seed_products(conn, 100)
+    hot = list(range(1, options.hot_skus + 1))
+    conn.executemany("UPDATE products SET stock = ? WHERE id = ?", [(options.stock, product_id) for product_id in hot])
+    conn.commit()
+    print(f"{options.shoppers} shoppers racing for {options.stock} units each of {len(hot)} products")
+
+    clients = []
+    for i in range(options.shoppers):
+        client = app.test_client()
+        client.post('/register', data={'username': f'shopper{i}', 'password': 'x'})
+        client.post('/login', data={'username': f'shopper{i}', 'password': 'x'})
+        clients.append((client, hot[i % len(hot)]))
+
+    def race(step):
+        barrier = threading.Barrier(len(clients))
+        samples = []
+
+        def shopper(client, product_id):
+            barrier.wait()
+            start = time.perf_counter()
+            step(client, product_id)
+            samples.append((time.perf_counter() - start) * 1000)
+
+        threads = [threading.Thread(target=shopper, args=pair) for pair in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return samples
+
+    add_ms = race(lambda client, product_id: client.post(f'/add_to_cart/{product_id}', data={'quantity': 1}))
+    held = {row[0]: row[1] for row in conn.execute(
+        "SELECT product_id, SUM(quantity) FROM stock_holds GROUP BY product_id")}
+
+    holders = []
+    for client, product_id in clients:
+        with client.session_transaction() as client_session:
+            if client_session.get('cart'):
+                holders.append((client, product_id))
+    clients = holders
+    placed = []
+    checkout_ms = race(lambda client, product_id: placed.append(
+        '/order_confirmation/' in client.post('/checkout', data={'payment_method': 'cash'}).headers.get('Location', '')))
+
+    stock = dict(conn.execute("SELECT id, stock FROM products WHERE id IN ({})".format(
+        ','.join('?' * len(hot))), hot).fetchall())
+    left = conn.execute("SELECT COUNT(*) FROM stock_holds").fetchone()[0]
+    conn.close()
+    report('hold', add_ms)
+    report('checkout', checkout_ms)
+    print(f"  {len(holders)} carts got a unit, {sum(placed)} orders placed, {left} holds left, "
+          f"stock now {sorted(stock.values())}")
+    if any(quantity > options.stock for quantity in held.values()) or not all(placed) \
+            or any(stock[product_id] < 0 for product_id in hot) \
+            or len(holders) != min(options.shoppers, options.stock * len(hot)):
+        print("  HOLDS INCONSISTENT")
+        sys.exit(1)
+
+def seed_catalog(conn, options):
+    start = time.perf_counter()
+    seed_products(conn, options.products)
+    seed_orders(conn, options.users, options.orders, options.reviews)
+    # Checkouts in the route benchmark must not run out of stock
+    conn.execute("UPDATE products SET stock = 1000000")
+    conn.commit()
+    print(f"seeded {options.products} products, {options.users} users, {options.orders} orders, "
+          f"{options.reviews} reviews in {time.perf_counter() - start:.1f} s")
+
+def bench_seed(options):
+    app.config['DATABASE'] = options.database
+    init_db()
+    conn = connect_db()
+    seed_catalog(conn, options)
+    conn.close()
+
+def use_templates_beside_app():
+    # The page templates may sit next to app.py instead of in templates/
+    if not os.path.isdir(os.path.join(app.root_path, app.template_folder)):
+        app.template_folder = app.root_path
+
+# Counts the statements each request runs, via a trace callback on every
+# pooled connection. Trigger bodies and FTS5's reads of its own shadow
+# tables are traced too but aren't separate round trips, so they're skipped.
+request_queries = []
+
+def count_queries():
+    connect = store.connect_db
+
+    def counting_connect(*args, **kwargs):
+        conn = connect(*args, **kwargs)
+        conn.set_trace_callback(trace_query)
+        return conn
+
+    def trace_query(statement):
+        if statement.startswith('--') or "'main'." in statement:
+            return
+        if has_request_context():
+            g.bench_queries = g.get('bench_queries', 0) + 1
+
+    @app.teardown_request
+    def record_queries(exception):
+        request_queries.append((request.endpoint, g.get('bench_queries', 0)))
+
+    store.connect_db = counting_connect
+
+# Each scenario returns (method, url, form data) for one request; the
+# signed-in ones run with a session for a seeded user who has a cart.
+ROUTE_SCENARIOS = [
+    ('home', False, lambda rnd, options: ('GET', '/', None)),
+    ('home filtered', False, lambda rnd, options: (
+        'GET', f'/?category={rnd.choice(CATEGORIES)}&sort=price_asc&min_price=5', None)),
+    ('home search', False, lambda rnd, options: ('GET', f'/?search={rnd.choice(WORDS)}', None)),
+    ('product_detail', False, lambda rnd, options: (
+        'GET', f'/product/{rnd.randint(1, options.products)}', None)),
+    ('view_cart', True, lambda rnd, options: ('GET', '/cart', None)),
+    ('view_orders', True, lambda rnd, options: ('GET', '/orders', None)),
+    ('checkout', True, lambda rnd, options: ('POST', '/checkout', {'payment_method': 'cash'})),
+]
+
+def signed_in_cookie(user_id, options):
+    # A session cookie signed by the app, as login() and add_to_cart() would leave it
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = user_id
+        session['username'] = f'bench{user_id}'
+        session['cart'] = {str(product_id): 1 for product_id in range(1, options.cart_lines + 1)}
+    return client.get_cookie('session').value
+
+# Both drivers send the same cookie every time, so a checkout doesn't empty
+# the cart for the next request
+class TestClientDriver:
+    def send(self, method, url, data, cookie):
+        client = app.test_client()
+        if cookie:
+            client.set_cookie('session', cookie)
+        response = client.open(url, method=method, data=data)
+        response.get_data()
+        return response.status_code
+
+    def close(self):
+        pass
+
+class WSGIServerDriver:
+    def __init__(self):
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.local = threading.local()
+
+    def send(self, method, url, data, cookie):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = http.client.HTTPConnection('127.0.0.1', self.server.port)
+        headers = {'Cookie': f'session={cookie}'} if cookie else {}
+        body = None
+        if data is not None:
+            body = urllib.parse.urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        conn.request(method, url, body=body, headers=headers)
+        response = conn.getresponse()
+        response.read()
+        if response.getheader('Connection', '').lower() == 'close' or response.version < 11:
+            conn.close()
+            self.local.conn = None
+        return response.status
+
+    def close(self):
+        self.server.shutdown()
+
+def run_scenario(driver, scenario, options, cookies):
+    label, signed_in, make_request = scenario
+    rnd = random.Random(label)
+    requests = [make_request(rnd, options) for _ in range(options.requests)]
+    # Compile templates and fill caches before anything is timed
+    for method, url, data in requests[:options.warmup]:
+        driver.send(method, url, data, cookies[0] if signed_in else None)
+    samples, statuses = [], {}
+    lock = threading.Lock()
+    del request_queries[:]
+
+    def worker(index):
+        for method, url, data in requests[index::options.threads]:
+            cookie = cookies[index % len(cookies)] if signed_in else None
+            start = time.perf_counter()
+            status = driver.send(method, url, data, cookie)
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                samples.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(options.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    queries = [count for _, count in request_queries]
+    return {
+        'p50': percentile(samples, 50),
+        'p95': percentile(samples, 95),
+        'p99': percentile(samples, 99),
+        'rps': len(samples) / wall,
+        'queries': statistics.mean(queries) if queries else 0,
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+    }
+
+def compare(result, base, tolerance):
+    # Latency and query count going up, or throughput going down, is worse
+    changes = []
+    for key, higher_is_worse in (('p95', True), ('rps', False), ('queries', True)):
+        if base.get(key):
+            change = (result[key] - base[key]) / base[key] * 100
+            regressed = change > 0 if higher_is_worse else change < 0
+            changes.append((key, change, regressed and abs(change) > tolerance))
+    return changes
+
+def bench_routes(options):
+    use_templates_beside_app()
+    # Failures show up in the status counts instead of a traceback per request
+    app.logger.disabled = True
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    app.config['PAGE_CACHE'] = options.page_cache
+    use_temp_database()
+    conn = connect_db()
+    seed_catalog(conn, options)
+    user_ids = [row[0] for row in conn.execute("SELECT id FROM users LIMIT ?", (options.threads,))]
+    conn.close()
+    count_queries()
+
+    cookies = [signed_in_cookie(user_id, options) for user_id in user_ids]
+    driver = WSGIServerDriver() if options.server else TestClientDriver()
+    baseline = {}
+    if options.baseline and os.path.exists(options.baseline):
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+
+    print(f"{options.requests} requests per route, {options.threads} threads, "
+          f"{'WSGI server' if options.server else 'test client'}")
+    print(f"  {'route':<16} {'p50':>9} {'p95':>9} {'p99':>9} {'req/s':>9} {'queries':>8}  statuses")
+    results = {}
+    regressions = 0
+    try:
+        for scenario in ROUTE_SCENARIOS:
+            label = scenario[0]
+            if options.routes and label not in options.routes:
+                continue
+            result = run_scenario(driver, scenario, options, cookies)
+            statuses = ' '.join(f'{status}x{count}' for status, count in result['statuses'].items())
+            print(f"  {label:<16} {result['p50']:7.2f}ms {result['p95']:7.2f}ms {result['p99']:7.2f}ms "
+                  f"{result['rps']:9.1f} {result['queries']:8.1f}  {statuses}")
+            # Timings of error responses say nothing about the route, so they
+            # are neither compared nor saved
+            if any(int(status) >= 500 for status in result['statuses']):
+                print('  ' + ' ' * 16 + '   server errors, left out of the baseline')
+                continue
+            results[label] = result
+            if label in baseline:
+                changes = compare(result, baseline[label], options.tolerance)
+                print('  ' + ' ' * 16 + '   '.join(
+                    f"{key} {change:+.1f}%{' REGRESSED' if regressed else ''}"
+                    for key, change, regressed in changes))
+                regressions += sum(regressed for _, _, regressed in changes)
+    finally:
+        driver.close()
+
+    if options.save_baseline:
+        with open(options.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"baseline written to {options.save_baseline}")
+    if regressions:
+        print(f"{regressions} regressions against {options.baseline}")
+        sys.exit(1)
+
+def add_seed_arguments(parser, products, users, orders, reviews):
+    parser.add_argument('--products', type=int, default=products)
+    parser.add_argument('--users', type=int, default=users)
+    parser.add_argument('--orders', type=int, default=orders)
+    parser.add_argument('--reviews', type=int, default=reviews)
+
+# Browses catalog listings on threads for a number of seconds and returns
+# request latencies in ms and the wall time
+def browse(urls, threads, seconds):
+    samples = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def worker(index):
+        client = app.test_client()
+        rnd = random.Random(index)
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            response = client.get(rnd.choice(urls))
+            response.get_data()
+            if response.status_code != 200:
+                raise RuntimeError(f'browse got {response.status_code}')
+            with lock:
+                samples.append((time.perf_counter() - start) * 1000)
+
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return samples, time.perf_counter() - start
+
+REPLICA_MODES = ['primary', 'readonly']
+
+def replica_mode(value):
+    if value not in REPLICA_MODES:
+        raise argparse.ArgumentTypeError(f"choose from {', '.join(REPLICA_MODES)}")
+    return value
+
+# Browse throughput for each READ_REPLICA mode, first with no writes and
+# then while a writer keeps the write lock busy with large stock updates
+def bench_replica(options):
+    use_templates_beside_app()
+    app.logger.disabled = True
+    app.config['PAGE_CACHE'] = False
+    use_temp_database()
+    conn = connect_db()
+    seed_products(conn, options.products)
+    conn.close()
+    urls = ([f'/?category={category}&sort=price_asc' for category in CATEGORIES] +
+            [f'/?search={word}' for word in WORDS[:8]])
+
+    print(f"{options.products} products, {options.threads} browsing threads, "
+          f"{options.write_rows} rows per write transaction")
+    print(f"  {'mode':<10} {'idle req/s':>10} {'p95':>9} {'storm req/s':>11} {'p95':>9} {'change':>7} "
+          f"{'commits/s':>9}")
+    for mode in options.modes or REPLICA_MODES:
+        app.config['READ_REPLICA'] = None if mode == 'primary' else mode
+        pool = app.extensions.pop('db_read_pool', None)
+        if pool is not None:
+            pool.close()
+        browse(urls, options.threads, 0.5)
+        idle, idle_wall = browse(urls, options.threads, options.seconds)
+
+        stop = threading.Event()
+        commits = []
+
+        def writer():
+            writer_conn = connect_db()
+            rnd = random.Random(1)
+            while not stop.is_set():
+                first = rnd.randint(1, max(1, options.products - options.write_rows))
+                writer_conn.execute("BEGIN IMMEDIATE")
+                writer_conn.execute("UPDATE products SET stock = stock + 1 WHERE id BETWEEN ? AND ?",
+                                    (first, first + options.write_rows - 1))
+                writer_conn.commit()
+                commits.append(time.perf_counter())
+            writer_conn.close()
+
+        writer_thread = threading.Thread(target=writer)
+        writer_thread.start()
+        storm, storm_wall = browse(urls, options.threads, options.seconds)
+        stop.set()
+        writer_thread.join()
+
+        idle_rps = len(idle) / idle_wall
+        storm_rps = len(storm) / storm_wall
+        print(f"  {mode:<10} {idle_rps:10.1f} {percentile(idle, 95):7.2f}ms {storm_rps:11.1f} "
+              f"{percentile(storm, 95):7.2f}ms {(storm_rps - idle_rps) / idle_rps * 100:+6.1f}% "
+              f"{len(commits) / storm_wall:9.1f}")
+
+# Catalog latency while attackers try stolen passwords against existing
+# accounts from many addresses. 'inline' hashes on request threads with no
+# limits, as before the hashing pool; 'pool' uses the configured pool,
+# queue limit and throttles.
+LOGIN_MODES = ['inline', 'pool']
+
+def bench_logins(options):
+    use_templates_beside_app()
+    app.logger.disabled = True
+    app.config['PAGE_CACHE'] = False
+    use_temp_database()
+    conn = connect_db()
+    seed_products(conn, options.products)
+    password = store.hash_password('correct horse', app.config['PASSWORD_HASH_METHOD'])
+    conn.executemany("INSERT INTO users (username, password) VALUES (?, ?)",
+                     [(f'victim{i}', password) for i in range(options.users)])
+    conn.commit()
+    conn.close()
+    urls = ([f'/?category={category}&sort=price_asc' for category in CATEGORIES] +
+            [f'/?search={word}' for word in WORDS[:8]])
+    defaults = {name: app.config[name] for name in
+                ('PASSWORD_HASH_WORKERS', 'PASSWORD_HASH_QUEUE', 'LOGIN_USER_ATTEMPTS', 'LOGIN_IP_ATTEMPTS')}
+
+    browse(urls, options.threads, 0.5)
+    idle, _ = browse(urls, options.threads, options.seconds)
+    print(f"{options.threads} browsing threads, {options.attackers} attackers, {options.users} accounts")
+    print(f"  {'mode':<8} {'p50':>9} {'p99':>9}   logins: {'tried':>6} {'hashed':>6} {'429':>6}")
+    print(f"  {'idle':<8} {percentile(idle, 50):7.2f}ms {percentile(idle, 99):7.2f}ms")
+    for mode in options.modes or LOGIN_MODES:
+        app.config.update(defaults)
+        if mode == 'inline':
+            app.config.update(PASSWORD_HASH_WORKERS=0, PASSWORD_HASH_QUEUE=1000000,
+                              LOGIN_USER_ATTEMPTS=1000000, LOGIN_IP_ATTEMPTS=1000000)
+        _, executor, _ = app.extensions.pop('hash_executor', (None, None, None))
+        if executor is not None:
+            executor.shutdown()
+        store.login_throttle = store.LoginThrottle()
+        # Start the pool's processes before timing
+        store.run_hash(store.hash_password, 'warm up', app.config['PASSWORD_HASH_METHOD'])
+
+        stop = threading.Event()
+        statuses = []
+
+        def attacker(index):
+            client = app.test_client()
+            rnd = random.Random(index)
+            while not stop.is_set():
+                response = client.post('/login', data={'username': f'victim{rnd.randrange(options.users)}',
+                                                       'password': 'hunter2'},
+                                       environ_base={'REMOTE_ADDR': f'10.{index}.{rnd.randrange(256)}.{rnd.randrange(256)}'})
+                statuses.append(response.status_code)
+
+        attackers = [threading.Thread(target=attacker, args=(i,)) for i in range(options.attackers)]
+        for thread in attackers:
+            thread.start()
+        time.sleep(0.5)
+        burst, _ = browse(urls, options.threads, options.seconds)
+        stop.set()
+        for thread in attackers:
+            thread.join()
+        rejected = statuses.count(429)
+        print(f"  {mode:<8} {percentile(burst, 50):7.2f}ms {percentile(burst, 99):7.2f}ms   "
+              f"{'':7} {len(statuses):6d} {len(statuses) - rejected:6d} {rejected:6d}")
+    app.config.update(defaults)
+
+def login_mode(value):
+    if value not in LOGIN_MODES:
+        raise argparse.ArgumentTypeError(f"choose from {', '.join(LOGIN_MODES)}")
+    return value
+
+ASSET_ROUTES = [
+    ('home', '/'),
+    ('home filtered', '/?category=Dairy&sort=price_asc'),
+    ('home search', '/?search=fresh'),
+    ('cart', '/cart'),
+    ('login', '/login'),
+    ('contact', '/contact'),
+]
+
+# Bytes on the wire and response time per page view before and after
+# assets moved out of base.html and text responses were compressed.
+# 'Before' pages are sent uncompressed with the stylesheet and script
+# inline again; 'after' pages are gzipped and link built assets, which a
+# browser fetches once and then keeps.
+def bench_assets(options):
+    use_templates_beside_app()
+    app.logger.disabled = True
+    app.config['PAGE_CACHE'] = options.page_cache
+    use_temp_database()
+    conn = connect_db()
+    seed_products(conn, options.products)
+    conn.close()
+    source = os.path.join(app.root_path, 'assets')
+    app.config['ASSETS_SOURCE'] = source
+    app.config['ASSETS_FOLDER'] = tempfile.mkdtemp(prefix='store-assets-')
+    manifest = store.build_assets(source, app.config['ASSETS_FOLDER'])
+    app.extensions['asset_manifest'] = manifest
+    inline = sum(os.path.getsize(os.path.join(source, name)) for name in manifest)
+    client = app.test_client()
+
+    def fetch(url, encodings):
+        response = client.get(url, headers={'Accept-Encoding': encodings})
+        body = response.get_data()
+        if response.status_code != 200:
+            raise RuntimeError(f'{url} got {response.status_code}')
+        return len(body)
+
+    print(f"{options.products} products, page cache {'on' if options.page_cache else 'off'}, "
+          f"{options.repeat} requests each")
+    print(f"  {'page':<16} {'before':>8} {'after':>8} {'saved':>6}   {'before':>9} {'after':>9}")
+    for label, url in ASSET_ROUTES:
+        app.config['COMPRESSION'] = False
+        before = fetch(url, 'identity') + inline
+        before_ms = time_calls(lambda: fetch(url, 'identity'), options.repeat)
+        app.config['COMPRESSION'] = True
+        after = fetch(url, 'gzip, br')
+        after_ms = time_calls(lambda: fetch(url, 'gzip, br'), options.repeat)
+        print(f"  {label:<16} {before:8d} {after:8d} {(1 - after / before) * 100:5.0f}%   "
+              f"{statistics.median(before_ms):7.2f}ms {statistics.median(after_ms):7.2f}ms")
+
+    print(f"  {'asset':<28} {'identity':>8} {'gzip':>8} {'br':>8}")
+    for name, built in manifest.items():
+        url = f'/static/assets/{built}'
+        sizes = [fetch(url, encodings) for encodings in ('identity', 'gzip', 'br')]
+        print(f"  {built:<28} " + ' '.join(f'{size:8d}' for size in sizes))
+
+CATALOG_ARGS = LISTING_ARGS + [
+    {'sort': 'newest'},
+    {'category': 'Meat', 'sort': 'price_desc', 'min_price': '10', 'max_price': '40'},
+    {'category': 'Fruits', 'sort': 'rating', 'min_rating': '3'},
+    {'sort': 'name', 'min_price': '49'},
+    {'category': 'Nonexistent'},
+]
+
+def sql_listing(conn, args, after, limit):
+    query, params, sort = build_product_query(args, after=after, limit=limit)
+    return conn.execute(query, params).fetchall(), sort
+
+def index_listing(conn, args, after, limit):
+    return store.catalog_index_page(conn, args, after=after, limit=limit)
+
+# Walks the first pages of every listing both ways and returns the
+# listings whose ids differ
+def catalog_mismatches(conn, page_size, pages):
+    mismatches = []
+    for args in CATALOG_ARGS:
+        after = None
+        for _ in range(pages):
+            sql_rows, sort = sql_listing(conn, args, after, page_size)
+            index_rows, _ = index_listing(conn, args, after, page_size)
+            if [row['id'] for row in sql_rows] != [row['id'] for row in index_rows]:
+                mismatches.append(args)
+                break
+            if len(sql_rows) < page_size:
+                break
+            after = store.encode_cursor(sort, sql_rows[-1])
+    return mismatches
+
+def change_catalog(conn, rnd, products):
+    # Re-price, re-categorize, rate, delete and add a few products
+    ids = [row[0] for row in conn.execute("SELECT id FROM products")]
+    for product_id in rnd.sample(ids, 50):
+        conn.execute("UPDATE products SET price = ?, category = ? WHERE id = ?",
+                     (round(rnd.uniform(0.5, 50), 2), rnd.choice(CATEGORIES), product_id))
+    conn.execute("INSERT INTO users (username, password) VALUES ('catalog-bench', 'x')")
+    user_id = conn.execute("SELECT id FROM users WHERE username = 'catalog-bench'").fetchone()[0]
+    conn.executemany('''INSERT INTO reviews (product_id, user_id, rating, comment, review_date)
+                        VALUES (?, ?, ?, '', '2024-01-01')''',
+                     [(product_id, user_id, rnd.randint(1, 5)) for product_id in rnd.sample(ids, 50)])
+    conn.executemany("DELETE FROM products WHERE id = ?", [(product_id,) for product_id in rnd.sample(ids, 5)])
+    conn.commit()
+    seed_products(conn, 10, seed=products)
+
+# The catalog index against the SQL listing queries: same pages, before and
+# after products change, and the time each takes per page
+def bench_catalog(options):
+    use_temp_database()
+    conn = connect_db()
+    seed_products(conn, options.products)
+    seed_orders(conn, options.products // 10, 0, reviews=options.products)
+    app.config['CATALOG_INDEX'] = True
+    app.config['CATALOG_INDEX_REFRESH'] = 0
+    store.sync_product_change_log(conn)
+    start = time.perf_counter()
+    store.catalog_index.refresh(conn, 0)
+    print(f"{options.products} products, index loaded in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    failures = catalog_mismatches(conn, options.page_size, 4)
+    rnd = random.Random(7)
+    change_catalog(conn, rnd, options.products)
+    start = time.perf_counter()
+    store.catalog_index.refresh(conn, 0)
+    print(f"changes applied in {(time.perf_counter() - start) * 1000:.1f} ms")
+    failures += catalog_mismatches(conn, options.page_size, 4)
+
+    app.config['CATALOG_INDEX_REFRESH'] = 1.0
+    print(f"  {'listing':<58} {'SQL':>9} {'index':>9}")
+    for args in CATALOG_ARGS:
+        label = ' '.join(f'{name}={value}' for name, value in args.items())
+        sql = time_calls(lambda: sql_listing(conn, args, None, options.page_size + 1), options.repeat)
+        index = time_calls(lambda: index_listing(conn, args, None, options.page_size + 1), options.repeat)
+        print(f"  {label:<58} {statistics.mean(sql):7.3f}ms {statistics.mean(index):7.3f}ms")
+    conn.close()
+    for args in failures:
+        print(f"MISMATCH {args}")
+    if failures:
+        sys.exit(1)
+
+# The same reports grouped straight from orders and order_items
+ADHOC_REPORTS = {
+    'day': '''SELECT substr(o.order_date, 1, 10) AS day, COUNT(DISTINCT o.id) AS orders,
+                     SUM(oi.quantity) AS units,
+                     SUM(CAST(ROUND(oi.price * 100) AS INTEGER) * oi.quantity) AS revenue_cents
+              FROM orders o JOIN order_items oi ON oi.order_id = o.id
+              WHERE o.order_date >= ? AND o.order_date < ? || 'U'
+              GROUP BY day ORDER BY day LIMIT ?''',
+    'category': '''SELECT p.category, COUNT(DISTINCT o.id) AS orders, SUM(oi.quantity) AS units,
+                          SUM(CAST(ROUND(oi.price * 100) AS INTEGER) * oi.quantity) AS revenue_cents
+                   FROM orders o JOIN order_items oi ON oi.order_id = o.id
+                   JOIN products p ON p.id = oi.product_id
+                   WHERE o.order_date >= ? AND o.order_date < ? || 'U'
+                   GROUP BY p.category ORDER BY revenue_cents DESC, p.category LIMIT ?''',
+    'product': '''SELECT oi.product_id, p.name, p.category, COUNT(DISTINCT o.id) AS orders,
+                         SUM(oi.quantity) AS units,
+                         SUM(CAST(ROUND(oi.price * 100) AS INTEGER) * oi.quantity) AS revenue_cents
+                  FROM orders o JOIN order_items oi ON oi.order_id = o.id
+                  JOIN products p ON p.id = oi.product_id
+                  WHERE o.order_date >= ? AND o.order_date < ? || 'U'
+                  GROUP BY oi.product_id ORDER BY revenue_cents DESC, oi.product_id LIMIT ?''',
+}
+
+# Report latency from the rollups and from ad-hoc GROUP BYs as the order
+# count grows; the rollup figures should stay flat
+def bench_reports(options):
+    use_temp_database()
+    conn = connect_db()
+    seed_products(conn, options.products)
+    start_day, end_day = '2024-06-01', '2024-06-30'
+    print(f"reports for {start_day}..{end_day} over {options.products} products, {options.repeat} runs each")
+    print(f"  {'orders':>8} {'report':<10} {'rollup':>9} {'ad hoc':>9}")
+    seeded = 0
+    failures = []
+    for total in sorted(options.orders):
+        seed_orders(conn, 100, total - seeded, reviews=0, seed=total)
+        seeded = total
+        start = time.perf_counter()
+        store.catch_up_sales(conn)
+        print(f"  {total:>8} rolled up in {(time.perf_counter() - start) * 1000:.0f} ms")
+        for by in store.SALES_REPORTS:
+            params = (start_day, end_day, 20)
+            rollup = time_calls(lambda: store.sales_report(conn, by, *params), options.repeat)
+            adhoc = time_calls(lambda: conn.execute(ADHOC_REPORTS[by], params).fetchall(), options.repeat)
+            print(f"  {'':>8} {by:<10} {statistics.mean(rollup):7.3f}ms {statistics.mean(adhoc):7.3f}ms")
+            expected = [tuple(row) for row in conn.execute(ADHOC_REPORTS[by], params)]
+            got = [tuple(row.values())[:-1] for row in store.sales_report(conn, by, *params)]
+            if got != expected:
+                failures.append((total, by))
+    conn.close()
+    for total, by in failures:
+        print(f"MISMATCH {by} report at {total} orders")
+    if failures:
+        sys.exit(1)
+
+# Co-purchases counted straight from order_items on each page view, with
+# the same product columns load_recommendations() returns
+ADHOC_RECOMMENDATIONS = '''SELECT p.id, p.name, p.price, p.image, p.category, p.stock, co.orders
+                           FROM (SELECT b.product_id, COUNT(DISTINCT a.order_id) AS orders
+                                 FROM order_items a JOIN order_items b
+                                   ON b.order_id = a.order_id AND b.product_id != a.product_id
+                                 WHERE a.product_id = ?
+                                 GROUP BY b.product_id) co
+                           JOIN products p ON p.id = co.product_id
+                           WHERE p.stock > 0
+                           ORDER BY co.orders DESC, p.id LIMIT ?'''
+
+# Full and incremental recommendation builds, and lookups from the top-K
+# table against counting co-purchases per view
+def bench_recommendations(options):
+    use_temp_database()
+    conn = connect_db()
+    seed_products(conn, options.products)
+    seed_orders(conn, 100, options.orders, reviews=0)
+    conn.execute("UPDATE products SET stock = 1000")
+    conn.commit()
+    limit = app.config['RECOMMENDATIONS_PER_PRODUCT']
+
+    start = time.perf_counter()
+    store.catch_up_recommendations(conn)
+    print(f"{options.orders} orders over {options.products} products, "
+          f"built in {(time.perf_counter() - start) * 1000:.0f} ms")
+    seed_orders(conn, 10, options.new_orders, reviews=0, seed=7)
+    start = time.perf_counter()
+    store.catch_up_recommendations(conn)
+    print(f"{options.new_orders} new orders added in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    rnd = random.Random(3)
+    product_ids = [rnd.randint(1, options.products) for _ in range(options.repeat)]
+    with app.test_request_context():
+        failures = [product_id for product_id in product_ids[:20]
+                    if [dict(row) for row in conn.execute(ADHOC_RECOMMENDATIONS, (product_id, limit))]
+                    != store.load_recommendations((product_id,), limit)]
+        lookups = iter(product_ids)
+        table = time_calls(lambda: store.load_recommendations((next(lookups),), limit), len(product_ids))
+    lookups = iter(product_ids)
+    adhoc = time_calls(lambda: [dict(row) for row in conn.execute(ADHOC_RECOMMENDATIONS, (next(lookups), limit))],
+                       len(product_ids))
+    print(f"  {conn.execute('SELECT COUNT(*) FROM order_items').fetchone()[0] / options.products:.0f} "
+          f"order lines per product")
+    conn.close()
+    report('top-K', table)
+    report('ad hoc', adhoc)
+    for product_id in failures:
+        print(f"MISMATCH recommendations for product {product_id}")
+    if failures:
+        sys.exit(1)
+
+def main():
+    parser = argparse.ArgumentParser(description='Store benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    search = commands.add_parser('search', help='FTS5 search vs LIKE scan')
+    search.add_argument('--products', type=int, default=20000)
+    search.add_argument('--repeat', type=int, default=20)
+    search.add_argument('terms', nargs='*')
+    search.set_defaults(func=bench_search)
+
+    plans = commands.add_parser('plans', help='check that route queries use indexes')
+    plans.add_argument('--products', type=int, default=5000)
+    plans.set_defaults(func=bench_plans)
+
+    checkout = commands.add_parser('checkout', help='concurrent checkouts of one product')
+    checkout.add_argument('--buyers', type=int, default=32)
+    checkout.add_argument('--stock', type=int, default=10)
+    checkout.set_defaults(func=bench_checkout)
+
+    holds = commands.add_parser('holds', help='cart holds on hot products, then checkout')
+    holds.add_argument('--shoppers', type=int, default=32)
+    holds.add_argument('--hot-skus', type=int, default=2)
+    holds.add_argument('--stock', type=int, default=10)
+    holds.set_defaults(func=bench_holds)
+
+    seed = commands.add_parser('seed', help='fill a database with a synthetic catalog')
+    seed.add_argument('--database', required=True)
+    add_seed_arguments(seed, 100000, 10000, 200000, 100000)
+    seed.set_defaults(func=bench_seed)
+
+    routes = commands.add_parser('routes', help='latency, throughput and queries per route')
+    add_seed_arguments(routes, 10000, 1000, 20000, 10000)
+    routes.add_argument('--requests', type=int, default=200)
+    routes.add_argument('--threads', type=int, default=4)
+    routes.add_argument('--warmup', type=int, default=10)
+    routes.add_argument('--cart-lines', type=int, default=3)
+    routes.add_argument('--server', action='store_true',
+                        help='drive a threaded WSGI server over HTTP instead of the test client')
+    routes.add_argument('--page-cache', action='store_true', help='leave the page cache on')
+    routes.add_argument('--baseline', help='compare against results saved with --save-baseline')
+    routes.add_argument('--save-baseline')
+    routes.add_argument('--tolerance', type=float, default=20,
+                        help='percent change against the baseline that counts as a regression')
+    routes.add_argument('routes', nargs='*', help='only run these routes')
+    routes.set_defaults(func=bench_routes)
+
+    catalog = commands.add_parser('catalog', help='catalog index against SQL listings')
+    catalog.add_argument('--products', type=int, default=20000)
+    catalog.add_argument('--page-size', type=int, default=24)
+    catalog.add_argument('--repeat', type=int, default=50)
+    catalog.set_defaults(func=bench_catalog)
+
+    reports = commands.add_parser('reports', help='sales reports from rollups vs ad-hoc queries')
+    reports.add_argument('--products', type=int, default=2000)
+    reports.add_argument('--repeat', type=int, default=20)
+    reports.add_argument('--orders', type=int, nargs='+', default=[10000, 50000, 200000])
+    reports.set_defaults(func=bench_reports)
+
+    recommendations = commands.add_parser('recommendations', help='co-purchase build and lookup')
+    recommendations.add_argument('--products', type=int, default=2000)
+    recommendations.add_argument('--orders', type=int, default=50000)
+    recommendations.add_argument('--new-orders', type=int, default=1000)
+    recommendations.add_argument('--repeat', type=int, default=200)
+    recommendations.set_defaults(func=bench_recommendations)
+
+    logins = commands.add_parser('logins', help='catalog latency during a credential-stuffing burst')
+    logins.add_argument('--products', type=int, default=20000)
+    logins.add_argument('--users', type=int, default=5000)
+    logins.add_argument('--threads', type=int, default=4)
+    logins.add_argument('--attackers', type=int, default=16)
+    logins.add_argument('--seconds', type=float, default=5)
+    logins.add_argument('modes', nargs='*', type=login_mode, metavar='MODE',
+                        help=f"any of {', '.join(LOGIN_MODES)} (default all)")
+    logins.set_defaults(func=bench_logins)
+
+    assets = commands.add_parser('assets', help='bytes on the wire with built assets and compression')
+    assets.add_argument('--products', type=int, default=5000)
+    assets.add_argument('--repeat', type=int, default=50)
+    assets.add_argument('--page-cache', action='store_true', help='leave the page cache on')
+    assets.set_defaults(func=bench_assets)
+
+    replica = commands.add_parser('replica', help='browse throughput during a write storm')
+    replica.add_argument('--products', type=int, default=20000)
+    replica.add_argument('--threads', type=int, default=4)
+    replica.add_argument('--seconds', type=float, default=3)
+    replica.add_argument('--write-rows', type=int, default=5000)
+    replica.add_argument('modes', nargs='*', type=replica_mode, metavar='MODE',
+                         help=f"READ_REPLICA modes to compare: {', '.join(REPLICA_MODES)} (default: all)")
+    replica.set_defaults(func=bench_replica)
+
+    options = parser.parse_args()
+    options.func(options)
+
+if __name__ == '__main__':
+    main()